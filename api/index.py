@@ -1,85 +1,1288 @@
+import time
+# Cold-start timing covers every import below
+_IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import bisect
+import gzip
+import hashlib
+import hmac
 import json
+import math
 import os
-import time
-import urllib.request
+import random
+import re
+import secrets
+import sqlite3
+import sys
+import tempfile
 import urllib.parse
-import urllib.error
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from typing import AsyncGenerator
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse
+from fastapi.responses import StreamingResponse, JSONResponse, HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
+from contextlib import asynccontextmanager
+
+# httpx, asyncpg and brotli are imported where first used, so a cold start only
+# pays for them once a request actually needs a provider, the database or the page.
+# Without FAST_START, startup imports httpx and asyncpg before serving instead.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = FastAPI()
 
-# Database connection utility
-@contextmanager
-def get_db_connection():
+def get_env_var(key: str, default: str = "") -> str:
+    return os.environ.get(key, default).strip()
+
+# Serverless cold-start mode: startup does no DB round trips and defers work to
+# the first request that needs it. On by default on Vercel.
+FAST_START = get_env_var("FAST_START", "1" if get_env_var("VERCEL") else "0") == "1"
+cold_start = {
+    "fast_start": FAST_START,
+    "import_seconds": None,
+    "first_request_seconds": None,
+    "first_response_after_import_seconds": None,
+    "schema": None,
+}
+
+def client_ip(request: Request) -> str:
+    # Vercel and other proxies usually put the client IP first in x-forwarded-for
+    forwarded_for = request.headers.get("x-forwarded-for")
+    if forwarded_for:
+        # Handle list like "103.21.244.0, 10.0.0.1" -> take the first one
+        return forwarded_for.split(",")[0].strip()
+    # Fallback to direct client host
+    return request.client.host if request.client else "unknown"
+
+# Metrics
+# In-process counters, gauges and fixed-bucket histograms, rendered in the
+# Prometheus text format at /api/metrics. Recording is a dict lookup plus a
+# bisect, cheap enough to leave on in production.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 500, 1000)
+
+METRIC_DEFINITIONS = {
+    "wcgr_ttft_seconds": ("histogram", "Time from upstream request to first streamed text", LATENCY_BUCKETS),
+    "wcgr_stream_duration_seconds": ("histogram", "Total upstream stream duration", LATENCY_BUCKETS),
+    "wcgr_stream_chunks_per_second": ("histogram", "Upstream delta chunks (~tokens) per second of streaming", RATE_BUCKETS),
+    "wcgr_upstream_connect_seconds": ("histogram", "Time until upstream response headers arrive", LATENCY_BUCKETS),
+    "wcgr_db_pool_wait_seconds": ("histogram", "Time spent waiting for a pooled DB connection", LATENCY_BUCKETS),
+    "wcgr_db_query_seconds": ("histogram", "DB statement latency", LATENCY_BUCKETS),
+    "wcgr_streams_in_flight": ("gauge", "Upstream provider streams currently open", None),
+    "wcgr_requests_in_flight": ("gauge", "Client prediction streams currently open", None),
+    "wcgr_streams_total": ("counter", "Upstream provider streams by outcome", None),
+    "wcgr_errors_total": ("counter", "Errors by type", None),
+    "wcgr_rejected_total": ("counter", "Requests turned away by admission control", None),
+    "wcgr_streams_cancelled_total": ("counter", "Upstream streams stopped before the provider finished, by reason", None),
+    "wcgr_cancelled_stream_seconds": ("histogram", "How long upstream streams had run when they were stopped", LATENCY_BUCKETS),
+    "wcgr_event_loop_lag_seconds": ("histogram", "How late the event loop woke up a periodic timer", LATENCY_BUCKETS),
+}
+
+class Metrics:
+    def __init__(self):
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict):
+        return (name, tuple(sorted(labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self._values[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            buckets = METRIC_DEFINITIONS[name][2]
+            histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+        histogram[0][bisect.bisect_left(METRIC_DEFINITIONS[name][2], value)] += 1
+        histogram[1] += value
+
+    def timer(self, name: str, **labels):
+        return _MetricTimer(self, name, labels)
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        items = list(labels) + list(extra)
+        if not items:
+            return ""
+        pairs = []
+        for k, v in items:
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append(f'{k}="{v}"')
+        return "{" + ",".join(pairs) + "}"
+
+    def render(self, extra_values: dict = None) -> str:
+        values = dict(self._values)
+        values.update(extra_values or {})
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), histogram in self._histograms.items():
+            by_name.setdefault(name, []).append((labels, histogram))
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text, buckets = METRIC_DEFINITIONS.get(name, ("gauge", "Point-in-time value of the matching /api/ping stat", None))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+class _MetricTimer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+metrics = Metrics()
+
+def error_type(exc: BaseException) -> str:
+    if isinstance(exc, UpstreamHTTPError):
+        return f"http_{exc.status_code}"
+    if isinstance(exc, DeadlineExceeded):
+        return f"deadline_{exc.phase}"
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(exc, httpx.TimeoutException):
+        return "timeout"
+    if httpx is not None and isinstance(exc, httpx.TransportError):
+        return "connect"
+    if isinstance(exc, ValueError):
+        return "decode"
+    return type(exc).__name__.lower()
+
+# Database connection pool
+# A single bounded asyncpg pool is created on startup and shared by all handlers.
+# asyncpg keeps a per-connection prepared statement cache, so the INSERT and the
+# history SELECT below are parsed and planned once per pooled connection.
+QUERY_LOG_COLUMNS = (
+    "user_text", "horizon", "severity", "model_used", "response_preview", "ip_address", "created_at",
+    "response_text", "provider", "token_count", "latency_ms",
+)
+INSERT_QUERY_SQL = (
+    f"INSERT INTO queries ({', '.join(QUERY_LOG_COLUMNS)}) "
+    f"VALUES ({', '.join(f'${i}' for i in range(1, len(QUERY_LOG_COLUMNS) + 1))})"
+)
+HISTORY_SQL = (
+    "SELECT id, user_text, horizon, severity, model_used, created_at FROM queries "
+    "WHERE ip_address = $1 ORDER BY created_at DESC, id DESC LIMIT $2"
+)
+SIMILAR_LOAD_SQL = (
+    "SELECT user_text, horizon, severity, response_text FROM queries "
+    "WHERE response_text IS NOT NULL AND response_text <> '' ORDER BY created_at DESC, id DESC LIMIT $1"
+)
+# Keyset page: everything strictly older than the (created_at, id) cursor. The
+# plain created_at bound is redundant but lets the planner skip newer partitions.
+HISTORY_BEFORE_SQL = (
+    "SELECT id, user_text, horizon, severity, model_used, created_at FROM queries "
+    "WHERE ip_address = $1 AND created_at <= $2 AND (created_at, id) < ($2, $3) "
+    "ORDER BY created_at DESC, id DESC LIMIT $4"
+)
+# Ranked full-text search over the caller's own history, keyset-paginated on
+# (rank, id). Only the page's rows get a ts_headline snippet.
+SEARCH_MATCHES = (
+    "SELECT id, user_text, horizon, severity, model_used, created_at, response_text, response_preview, query, "
+    "ts_rank(search_vector, query) AS rank "
+    "FROM queries, websearch_to_tsquery('english', $2) AS query "
+    "WHERE ip_address = $1 AND search_vector @@ query"
+)
+SEARCH_COLUMNS = (
+    "SELECT id, user_text, horizon, severity, model_used, created_at, rank, "
+    "ts_headline('english', COALESCE(response_text, response_preview, ''), query, "
+    "'MaxFragments=1, MaxWords=25, MinWords=8') AS snippet "
+)
+SEARCH_SQL = f"{SEARCH_COLUMNS}FROM ({SEARCH_MATCHES}) matches ORDER BY rank DESC, id DESC LIMIT $3"
+SEARCH_AFTER_SQL = (
+    f"{SEARCH_COLUMNS}FROM ({SEARCH_MATCHES}) matches "
+    "WHERE (rank, id) < ($3::real, $4) ORDER BY rank DESC, id DESC LIMIT $5"
+)
+# Rollups are bumped in the same transaction as each write-behind flush
+ROLLUP_HOURLY_SQL = (
+    "INSERT INTO query_rollup_hourly AS r (bucket, horizon, severity, model_used, requests, "
+    "response_chars, response_chars_max, tokens, latency_ms_total) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9) "
+    "ON CONFLICT (bucket, horizon, severity, model_used) DO UPDATE SET "
+    "requests = r.requests + EXCLUDED.requests, response_chars = r.response_chars + EXCLUDED.response_chars, "
+    "response_chars_max = GREATEST(r.response_chars_max, EXCLUDED.response_chars_max), "
+    "tokens = r.tokens + EXCLUDED.tokens, latency_ms_total = r.latency_ms_total + EXCLUDED.latency_ms_total"
+)
+ROLLUP_IP_DAILY_SQL = (
+    "INSERT INTO query_rollup_ip_daily AS r (day, ip_address, requests) VALUES ($1, $2, $3) "
+    "ON CONFLICT (day, ip_address) DO UPDATE SET requests = r.requests + EXCLUDED.requests"
+)
+STATS_HOURLY_SQL = (
+    "SELECT bucket, SUM(requests)::bigint AS requests FROM query_rollup_hourly "
+    "WHERE bucket >= $1 GROUP BY bucket ORDER BY bucket"
+)
+STATS_BREAKDOWN_SQL = (
+    "SELECT horizon, severity, model_used, SUM(requests)::bigint AS requests, SUM(response_chars)::bigint AS response_chars, "
+    "MAX(response_chars_max) AS response_chars_max, SUM(tokens)::bigint AS tokens, SUM(latency_ms_total)::bigint AS latency_ms_total "
+    "FROM query_rollup_hourly WHERE bucket >= $1 GROUP BY horizon, severity, model_used ORDER BY requests DESC"
+)
+STATS_TOP_IPS_SQL = (
+    "SELECT ip_address, SUM(requests)::bigint AS requests FROM query_rollup_ip_daily "
+    "WHERE day >= $1 GROUP BY ip_address ORDER BY requests DESC, ip_address LIMIT $2"
+)
+
+_db_pool = None
+_db_pool_lock = asyncio.Lock()
+_db_last_release = {}
+_db_stats = {
+    "checkouts": 0,
+    "checkout_errors": 0,
+    "health_check_failures": 0,
+    "wait_seconds_total": 0.0,
+    "wait_seconds_max": 0.0,
+}
+
+async def get_db_pool():
+    global _db_pool
+    database_url = get_env_var("POSTGRES_URL")
+    if not database_url:
+        return None
+    if _db_pool is not None:
+        return _db_pool
+    async with _db_pool_lock:
+        if _db_pool is None:
+            import asyncpg
+            _db_pool = await asyncpg.create_pool(
+                database_url,
+                min_size=int(get_env_var("DB_POOL_MIN_SIZE", "1")),
+                max_size=int(get_env_var("DB_POOL_MAX_SIZE", "10")),
+                # Idle connections are closed and replaced after this many seconds
+                max_inactive_connection_lifetime=float(get_env_var("DB_POOL_MAX_IDLE", "300")),
+                max_queries=int(get_env_var("DB_POOL_MAX_QUERIES", "50000")),
+                # Set to 0 when going through pgbouncer in transaction mode
+                statement_cache_size=int(get_env_var("DB_STATEMENT_CACHE_SIZE", "100")),
+                setup=_db_health_check,
+            )
+    return _db_pool
+
+async def _db_health_check(conn):
+    # Only ping connections that sat idle long enough for the server or a proxy to drop them
+    idle_limit = float(get_env_var("DB_HEALTH_CHECK_IDLE", "30"))
+    last_used = _db_last_release.get(conn.get_server_pid())
+    if last_used is not None and time.monotonic() - last_used > idle_limit:
+        await conn.execute("SELECT 1")
+
+def db_pool_stats() -> dict:
+    stats = dict(_db_stats)
+    if _db_pool is not None:
+        stats["size"] = _db_pool.get_size()
+        stats["idle"] = _db_pool.get_idle_size()
+        stats["min_size"] = _db_pool.get_min_size()
+        stats["max_size"] = _db_pool.get_max_size()
+    return stats
+
+@asynccontextmanager
+async def get_db_connection():
     conn = None
     try:
-        database_url = get_env_var("POSTGRES_URL")
-        if database_url:
-            conn = psycopg2.connect(database_url)
-            yield conn
-        else:
-            yield None
+        pool = await get_db_pool()
+        if pool is not None:
+            import asyncpg
+            timeout = float(get_env_var("DB_POOL_ACQUIRE_TIMEOUT", "5"))
+            start = time.perf_counter()
+            for attempt in range(2):
+                try:
+                    conn = await pool.acquire(timeout=timeout)
+                    break
+                except (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError):
+                    # Failed health check: the pool drops the connection, retry once with a fresh one
+                    _db_stats["health_check_failures"] += 1
+                    if attempt:
+                        raise
+            wait = time.perf_counter() - start
+            metrics.observe("wcgr_db_pool_wait_seconds", wait)
+            _db_stats["checkouts"] += 1
+            _db_stats["wait_seconds_total"] += wait
+            _db_stats["wait_seconds_max"] = max(_db_stats["wait_seconds_max"], wait)
     except Exception as e:
+        _db_stats["checkout_errors"] += 1
+        metrics.inc("wcgr_errors_total", type="db_checkout")
         print(f"Database connection error: {e}")
-        yield None
+        conn = None
+    try:
+        yield conn
     finally:
-        if conn:
-            conn.close()
+        if conn is not None:
+            if len(_db_last_release) > 1000:
+                _db_last_release.clear()
+            _db_last_release[conn.get_server_pid()] = time.monotonic()
+            await _db_pool.release(conn)
+
+# Write-behind query log
+# Finished forecasts are only enqueued; a background task writes batches with COPY
+# once LOG_BATCH_SIZE rows are pending or LOG_FLUSH_INTERVAL seconds have passed.
+# Off by default on Vercel: a frozen serverless instance may never run the flush.
+LOG_WRITE_BEHIND = get_env_var("LOG_WRITE_BEHIND", "0" if get_env_var("VERCEL") else "1") == "1"
+
+class QueryLogWriter:
+    def __init__(self):
+        self.max_pending = int(get_env_var("LOG_MAX_PENDING", "10000"))
+        self.batch_size = int(get_env_var("LOG_BATCH_SIZE", "500"))
+        self.flush_interval = float(get_env_var("LOG_FLUSH_INTERVAL", "0.25"))
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = None
+        self._collecting = []
+        self._writing = None
+        self._in_flight = 0
+        self.stats = {"enqueued": 0, "flushed": 0, "dropped": 0, "batches": 0, "failed_batches": 0}
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, row: tuple) -> bool:
+        # Never blocks: callers are finishing (or abandoned) response streams
+        try:
+            self._queue.put_nowait(row)
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        return True
+
+    async def _run(self):
+        while True:
+            self._collecting = [await self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(self._collecting) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._collecting.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._collecting = self._collecting, []
+            # Shielded so that shutdown can't interrupt a COPY halfway through
+            self._writing = asyncio.ensure_future(self.write(batch))
+            await asyncio.shield(self._writing)
+
+    async def write(self, batch: list):
+        self._in_flight += len(batch)
+        try:
+            async with get_db_connection() as conn:
+                if not conn:
+                    self.stats["dropped"] += len(batch)
+                    return
+                async with conn.transaction():
+                    if len(batch) == 1:
+                        with metrics.timer("wcgr_db_query_seconds", query="insert"):
+                            await conn.execute(INSERT_QUERY_SQL, *batch[0])
+                    else:
+                        with metrics.timer("wcgr_db_query_seconds", query="copy"):
+                            await conn.copy_records_to_table("queries", records=batch, columns=QUERY_LOG_COLUMNS)
+                    with metrics.timer("wcgr_db_query_seconds", query="rollup"):
+                        await update_rollups(conn, batch)
+            self.stats["flushed"] += len(batch)
+            self.stats["batches"] += 1
+            for row in batch:
+                history_cache.invalidate(row[5])
+        except Exception as e:
+            print(f"Query log flush error: {e}")
+            metrics.inc("wcgr_errors_total", type="db_write")
+            self.stats["dropped"] += len(batch)
+            self.stats["failed_batches"] += 1
+        finally:
+            self._in_flight -= len(batch)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._writing is not None and not self._writing.done():
+            await self._writing
+        # Flush whatever is still queued before the pool goes away
+        if self._collecting:
+            batch, self._collecting = self._collecting, []
+            # Shielded so that shutdown can't interrupt a COPY halfway through
+            self._writing = asyncio.ensure_future(self.write(batch))
+            await asyncio.shield(self._writing)
+        while not self._queue.empty():
+            batch = []
+            while not self._queue.empty() and len(batch) < self.batch_size:
+                batch.append(self._queue.get_nowait())
+            await self.write(batch)
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, pending=self._queue.qsize() + len(self._collecting) + self._in_flight)
+
+query_log_writer = QueryLogWriter()
+
+# Usage rollups
+# Hourly counters per (horizon, severity, model_used) and daily counters per IP,
+# aggregated in memory for each flushed batch and upserted in sorted key order
+# so concurrent workers can't deadlock on each other's rows.
+def rollup_batch(batch: list):
+    hourly = {}
+    ip_daily = {}
+    for row in batch:
+        created_at = row[6].astimezone(timezone.utc)
+        response = row[7] if row[7] is not None else (row[4] or "")
+        key = (created_at.replace(minute=0, second=0, microsecond=0), row[1] or "", row[2] or "", row[3] or "")
+        totals = hourly.setdefault(key, [0, 0, 0, 0, 0])
+        totals[0] += 1
+        totals[1] += len(response)
+        totals[2] = max(totals[2], len(response))
+        totals[3] += row[9] or 0
+        totals[4] += row[10] or 0
+        day_key = (created_at.date(), row[5] or "")
+        ip_daily[day_key] = ip_daily.get(day_key, 0) + 1
+    return (
+        [key + tuple(totals) for key, totals in sorted(hourly.items())],
+        [key + (count,) for key, count in sorted(ip_daily.items())],
+    )
+
+async def update_rollups(conn, batch: list):
+    hourly, ip_daily = rollup_batch(batch)
+    await conn.executemany(ROLLUP_HOURLY_SQL, hourly)
+    await conn.executemany(ROLLUP_IP_DAILY_SQL, ip_daily)
+
+@app.on_event("shutdown")
+async def shutdown():
+    global _db_pool
+    if _loop_lag_task is not None:
+        _loop_lag_task.cancel()
+    if _schema_task is not None:
+        await asyncio.gather(_schema_task, return_exceptions=True)
+    if _shared_sync_task is not None:
+        _shared_sync_task.cancel()
+    if _partition_task is not None:
+        _partition_task.cancel()
+        await asyncio.gather(_partition_task, return_exceptions=True)
+    await similar_index.close()
+    await query_log_writer.close()
+    if shared_state is not None:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+        await shared_state.close()
+    if _db_pool is not None:
+        await _db_pool.close()
+        _db_pool = None
+
+# Schema migrations
+# Versioned DDL applied in order by `python migrate.py`, recorded in
+# schema_migrations. Startup only checks the recorded version (applying what is
+# missing when DB_AUTO_MIGRATE=1) and then drops a marker file, so later boots
+# on the same instance skip the database entirely.
+MIGRATIONS = [
+    (1, "create queries", """
+        CREATE TABLE IF NOT EXISTS queries (
+            id SERIAL PRIMARY KEY,
+            user_text TEXT NOT NULL,
+            horizon VARCHAR(50),
+            severity VARCHAR(50),
+            model_used VARCHAR(100),
+            response_preview TEXT,
+            ip_address VARCHAR(45),
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """),
+    # Tables created before ip_address existed
+    (2, "queries.ip_address", "ALTER TABLE queries ADD COLUMN IF NOT EXISTS ip_address VARCHAR(45)"),
+    # Serves the per-IP history lookup and its keyset pagination
+    (3, "history index", "CREATE INDEX IF NOT EXISTS queries_ip_created_at_idx ON queries (ip_address, created_at DESC, id DESC)"),
+    # Full forecast persisted server-side by /api/predict
+    (4, "persisted forecasts", """
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS response_text TEXT;
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS provider VARCHAR(50);
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS token_count INTEGER;
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS latency_ms INTEGER;
+    """),
+    # Usage rollups for /api/stats, backfilled from the rows already logged
+    (5, "usage rollups", """
+        CREATE TABLE IF NOT EXISTS query_rollup_hourly (
+            bucket TIMESTAMPTZ NOT NULL,
+            horizon VARCHAR(50) NOT NULL,
+            severity VARCHAR(50) NOT NULL,
+            model_used VARCHAR(100) NOT NULL,
+            requests BIGINT NOT NULL DEFAULT 0,
+            response_chars BIGINT NOT NULL DEFAULT 0,
+            response_chars_max INTEGER NOT NULL DEFAULT 0,
+            tokens BIGINT NOT NULL DEFAULT 0,
+            latency_ms_total BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, horizon, severity, model_used)
+        );
+        CREATE TABLE IF NOT EXISTS query_rollup_ip_daily (
+            day DATE NOT NULL,
+            ip_address VARCHAR(45) NOT NULL,
+            requests BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, ip_address)
+        );
+        INSERT INTO query_rollup_hourly
+        SELECT date_trunc('hour', created_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+               COALESCE(horizon, ''), COALESCE(severity, ''), COALESCE(model_used, ''), COUNT(*),
+               SUM(length(COALESCE(response_text, response_preview, ''))),
+               MAX(length(COALESCE(response_text, response_preview, ''))),
+               SUM(COALESCE(token_count, 0)), SUM(COALESCE(latency_ms, 0))
+        FROM queries WHERE created_at IS NOT NULL GROUP BY 1, 2, 3, 4
+        ON CONFLICT DO NOTHING;
+        INSERT INTO query_rollup_ip_daily
+        SELECT (created_at AT TIME ZONE 'UTC')::date, COALESCE(ip_address, ''), COUNT(*)
+        FROM queries WHERE created_at IS NOT NULL GROUP BY 1, 2
+        ON CONFLICT DO NOTHING;
+    """),
+    # Full-text search over the input and the stored forecast. Adding a stored
+    # generated column rewrites the table once.
+    (6, "history search", """
+        ALTER TABLE queries ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', COALESCE(user_text, '')), 'A') ||
+            setweight(to_tsvector('english', COALESCE(response_text, response_preview, '')), 'B')
+        ) STORED;
+        CREATE INDEX IF NOT EXISTS queries_search_idx ON queries USING GIN (search_vector);
+    """),
+    # Monthly range partitions on created_at (see maintain_partitions). The rows
+    # are copied once into the new table; the id sequence carries over.
+    (7, "monthly partitions", """
+        ALTER TABLE queries RENAME TO queries_unpartitioned;
+        ALTER INDEX IF EXISTS queries_pkey RENAME TO queries_unpartitioned_pkey;
+        ALTER INDEX IF EXISTS queries_ip_created_at_idx RENAME TO queries_unpartitioned_ip_created_at_idx;
+        ALTER INDEX IF EXISTS queries_search_idx RENAME TO queries_unpartitioned_search_idx;
+        ALTER SEQUENCE queries_id_seq OWNED BY NONE;
+        CREATE TABLE queries (
+            id INTEGER NOT NULL DEFAULT nextval('queries_id_seq'),
+            user_text TEXT NOT NULL,
+            horizon VARCHAR(50),
+            severity VARCHAR(50),
+            model_used VARCHAR(100),
+            response_preview TEXT,
+            ip_address VARCHAR(45),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            response_text TEXT,
+            provider VARCHAR(50),
+            token_count INTEGER,
+            latency_ms INTEGER,
+            search_vector tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', COALESCE(user_text, '')), 'A') ||
+                setweight(to_tsvector('english', COALESCE(response_text, response_preview, '')), 'B')
+            ) STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        ALTER SEQUENCE queries_id_seq OWNED BY queries.id;
+        CREATE TABLE queries_default PARTITION OF queries DEFAULT;
+        DO $$
+        DECLARE
+            month DATE;
+        BEGIN
+            FOR month IN
+                SELECT generate_series(
+                    date_trunc('month', COALESCE(MIN(created_at), NOW()) AT TIME ZONE 'UTC'),
+                    date_trunc('month', NOW() AT TIME ZONE 'UTC') + INTERVAL '3 months',
+                    INTERVAL '1 month'
+                )::date
+                FROM queries_unpartitioned
+            LOOP
+                EXECUTE format(
+                    'CREATE TABLE %I PARTITION OF queries FOR VALUES FROM (%L) TO (%L)',
+                    'queries_' || to_char(month, '"y"YYYY"m"MM'),
+                    month::timestamp AT TIME ZONE 'UTC',
+                    (month + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+                );
+            END LOOP;
+        END $$;
+        INSERT INTO queries (id, user_text, horizon, severity, model_used, response_preview, ip_address,
+                             created_at, response_text, provider, token_count, latency_ms)
+        SELECT id, user_text, horizon, severity, model_used, response_preview, ip_address,
+               COALESCE(created_at, NOW()), response_text, provider, token_count, latency_ms
+        FROM queries_unpartitioned;
+        DROP TABLE queries_unpartitioned;
+        CREATE INDEX queries_ip_created_at_idx ON queries (ip_address, created_at DESC, id DESC);
+        CREATE INDEX queries_search_idx ON queries USING GIN (search_vector);
+    """),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+# Arbitrary key for pg_advisory_xact_lock, so concurrent deploys migrate one at a time
+MIGRATION_LOCK_ID = 0x57434752
+
+async def current_schema_version(conn) -> int:
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+
+async def apply_migrations(conn) -> list:
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT NOW()
+        )
+    """)
+    applied = []
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        done = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+        for version, name, sql in MIGRATIONS:
+            if version in done:
+                continue
+            await conn.execute(sql)
+            await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+            applied.append(version)
+    return applied
+
+def schema_marker_path() -> str:
+    # One marker per database, so pointing POSTGRES_URL elsewhere re-checks
+    database = hashlib.sha256(get_env_var("POSTGRES_URL").encode("utf-8")).hexdigest()[:16]
+    default = os.path.join(tempfile.gettempdir(), f"wcgr-schema-{database}")
+    return get_env_var("SCHEMA_MARKER_PATH", default)
+
+def schema_marker_ok() -> bool:
+    try:
+        with open(schema_marker_path()) as f:
+            return int(f.read().strip() or 0) >= SCHEMA_VERSION
+    except (OSError, ValueError):
+        return False
+
+def write_schema_marker():
+    try:
+        with open(schema_marker_path(), "w") as f:
+            f.write(str(SCHEMA_VERSION))
+    except OSError as e:
+        print(f"Could not write schema marker: {e}")
+
+async def ensure_schema():
+    if not get_env_var("POSTGRES_URL"):
+        return
+    if schema_marker_ok():
+        cold_start["schema"] = "marker"
+        return
+    async with get_db_connection() as conn:
+        if not conn:
+            return
+        try:
+            version = await current_schema_version(conn)
+            if version < SCHEMA_VERSION:
+                if get_env_var("DB_AUTO_MIGRATE", "0") != "1":
+                    cold_start["schema"] = f"outdated ({version})"
+                    print(f"Database schema is at version {version}, expected {SCHEMA_VERSION}; run `python migrate.py`")
+                    return
+                applied = await apply_migrations(conn)
+                print(f"Applied database migrations: {applied}")
+            cold_start["schema"] = "checked"
+            write_schema_marker()
+        except Exception as e:
+            print(f"Database schema check error: {e}")
+
+# Monthly partitions and retention
+# queries is range-partitioned by month on created_at (migration 7), with a
+# DEFAULT partition catching anything outside the monthly ones. maintain_partitions
+# creates the next PARTITION_PREMAKE_MONTHS months ahead of time; it runs from
+# `python migrate.py` and, on long-running servers, every
+# PARTITION_MAINTENANCE_INTERVAL seconds. With PARTITION_RETENTION_MONTHS set,
+# older months are detached, exported to ARCHIVE_DIR as gzip-ed CSV and dropped.
+# The rollup tables are untouched, so /api/stats still covers archived months.
+PARTITION_LOCK_ID = MIGRATION_LOCK_ID + 1
+PARTITION_NAME = re.compile(r"^queries_y(\d{4})m(\d{2})$")
+PARTITION_COLUMNS = ("id",) + QUERY_LOG_COLUMNS
+
+def add_months(year: int, month: int, count: int) -> tuple:
+    index = year * 12 + (month - 1) + count
+    return index // 12, index % 12 + 1
+
+def partition_name(year: int, month: int) -> str:
+    return f"queries_y{year:04d}m{month:02d}"
+
+def month_bounds(year: int, month: int) -> tuple:
+    next_year, next_month = add_months(year, month, 1)
+    return datetime(year, month, 1, tzinfo=timezone.utc), datetime(next_year, next_month, 1, tzinfo=timezone.utc)
+
+async def create_partition(conn, year: int, month: int) -> bool:
+    """Create one monthly partition, moving any rows the DEFAULT partition took for that month."""
+    name = partition_name(year, month)
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name):
+        return False
+    start, end = month_bounds(year, month)
+    columns = ", ".join(PARTITION_COLUMNS)
+    async with conn.transaction():
+        stray = await conn.fetchval(
+            "SELECT EXISTS (SELECT 1 FROM queries_default WHERE created_at >= $1 AND created_at < $2)", start, end
+        )
+        if stray:
+            # Postgres refuses a new partition whose range overlaps rows in DEFAULT
+            await conn.execute("ALTER TABLE queries DETACH PARTITION queries_default")
+        await conn.execute(
+            f"CREATE TABLE {name} PARTITION OF queries FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+        if stray:
+            moved = await conn.execute(
+                f"WITH moved AS (DELETE FROM queries_default WHERE created_at >= $1 AND created_at < $2 RETURNING {columns}) "
+                f"INSERT INTO {name} ({columns}) SELECT {columns} FROM moved",
+                start, end,
+            )
+            await conn.execute("ALTER TABLE queries ATTACH PARTITION queries_default DEFAULT")
+            print(f"Moved {moved.split()[-1]} rows from queries_default into {name}")
+    return True
+
+async def archive_partition(conn, name: str, archive_dir: str) -> int:
+    """Detach a monthly partition, export it to <archive_dir>/<name>.csv.gz and drop it."""
+    attached = await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_inherits WHERE inhparent = 'queries'::regclass AND inhrelid = to_regclass($1))",
+        name,
+    )
+    if attached:
+        await conn.execute(f"ALTER TABLE queries DETACH PARTITION {name}")
+    rows = await conn.fetchval(f"SELECT COUNT(*) FROM {name}")
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    # Written under a temporary name so a crash never leaves a truncated archive
+    # behind; the detached table is only dropped once the file is complete
+    partial = path + ".part"
+    with gzip.open(partial, "wb") as f:
+        async def write(chunk):
+            await asyncio.to_thread(f.write, chunk)
+        await conn.copy_from_table(name, columns=list(PARTITION_COLUMNS), output=write, format="csv", header=True)
+    os.replace(partial, path)
+    await conn.execute(f"DROP TABLE {name}")
+    print(f"Archived {rows} rows from {name} to {path}")
+    return rows
+
+async def maintain_partitions(conn) -> dict:
+    result = {"created": [], "archived": []}
+    if not await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('queries')"):
+        return result
+    # One maintainer at a time across workers and deploys; the others skip this round
+    if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", PARTITION_LOCK_ID):
+        return result
+    try:
+        now = datetime.now(timezone.utc)
+        for ahead in range(int(get_env_var("PARTITION_PREMAKE_MONTHS", "3")) + 1):
+            year, month = add_months(now.year, now.month, ahead)
+            if await create_partition(conn, year, month):
+                result["created"].append(partition_name(year, month))
+
+        retention = int(get_env_var("PARTITION_RETENTION_MONTHS", "0"))
+        if retention > 0:
+            cutoff = add_months(now.year, now.month, -retention)
+            # Attached partitions and ones detached by an earlier, interrupted run
+            names = await conn.fetch("SELECT relname FROM pg_class WHERE relkind = 'r' AND relname ~ '^queries_y[0-9]{4}m[0-9]{2}$'")
+            archive_dir = get_env_var("ARCHIVE_DIR", "archive")
+            for (name,) in sorted(names):
+                match = PARTITION_NAME.match(name)
+                if (int(match.group(1)), int(match.group(2))) < cutoff:
+                    await archive_partition(conn, name, archive_dir)
+                    result["archived"].append(name)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", PARTITION_LOCK_ID)
+    if result["created"] or result["archived"]:
+        print(f"Partition maintenance: {result}")
+    return result
+
+_partition_task = None
+
+async def _maintain_partitions_periodically(interval: float):
+    while True:
+        try:
+            async with get_db_connection() as conn:
+                if conn:
+                    await maintain_partitions(conn)
+        except Exception as e:
+            print(f"Partition maintenance error: {e}")
+        await asyncio.sleep(interval)
+
+def start_partition_maintenance():
+    global _partition_task
+    interval = float(get_env_var("PARTITION_MAINTENANCE_INTERVAL", "21600"))
+    if get_env_var("POSTGRES_URL") and interval > 0 and (_partition_task is None or _partition_task.done()):
+        _partition_task = asyncio.create_task(_maintain_partitions_periodically(interval))
+
+_schema_task = None
 
-# Initialize database table on startup
 @app.on_event("startup")
 async def startup():
-    with get_db_connection() as conn:
-        if conn:
+    global _schema_task
+    if FAST_START:
+        # Nothing here may wait on the database; index.html is loaded by the first GET /
+        # The similar-input index is seeded by the first similarity lookup, not here
+        _schema_task = asyncio.create_task(ensure_schema())
+    else:
+        # A long-lived server pays for these at boot instead of on the first request
+        import httpx
+        import asyncpg
+        await ensure_schema()
+        similar_index.start_loading()
+        frontend_asset.refresh()
+        # Serverless instances don't live long enough; run `python migrate.py` from cron there
+        start_partition_maintenance()
+    query_log_writer.start()
+    start_loop_lag_monitor()
+    start_shared_state_sync()
+
+# Event loop lag: anything blocking the loop shows up as a late timer wake-up
+_loop_lag_task = None
+
+async def _monitor_loop_lag(interval: float):
+    while True:
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        metrics.observe("wcgr_event_loop_lag_seconds", max(0.0, time.perf_counter() - expected))
+
+def start_loop_lag_monitor():
+    global _loop_lag_task
+    interval = float(get_env_var("LOOP_LAG_INTERVAL", "0.25"))
+    if interval > 0 and (_loop_lag_task is None or _loop_lag_task.done()):
+        _loop_lag_task = asyncio.create_task(_monitor_loop_lag(interval))
+
+# Shared state across workers
+# With SHARED_STATE_URL set, uvicorn workers share the forecast cache (as an L2
+# behind the in-process LRU), rate-limit counters, open circuit breakers and
+# history-cache invalidations. Two backends:
+#   sqlite:///path/state.db   one host, many workers: SQLite in WAL mode (mmap'd
+#                             reads, one atomic statement per operation, run
+#                             on a per-process thread)
+#   redis://[:password@]host:port/db   anything speaking RESP2
+# Every key carries a TTL. Backend errors are logged and treated as misses, so
+# a broken backend degrades to per-worker state instead of failing requests.
+class SharedState:
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.stats = {"gets": 0, "hits": 0, "sets": 0, "errors": 0}
+
+    async def get(self, key: str):
+        self.stats["gets"] += 1
+        try:
+            value = await self._get(self.prefix + key)
+        except Exception as e:
+            self._failed("get", e)
+            return None
+        if value is not None:
+            self.stats["hits"] += 1
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self.stats["sets"] += 1
+        try:
+            await self._set(self.prefix + key, value, ttl)
+        except Exception as e:
+            self._failed("set", e)
+
+    async def delete(self, key: str):
+        try:
+            await self._delete(self.prefix + key)
+        except Exception as e:
+            self._failed("delete", e)
+
+    async def incr(self, key: str, amount: int, ttl: float):
+        """Atomically add to a counter, creating it with the TTL. None on backend errors."""
+        try:
+            return int(await self._incr(self.prefix + key, amount, ttl))
+        except Exception as e:
+            self._failed("incr", e)
+            return None
+
+    def _failed(self, operation: str, exc: Exception):
+        self.stats["errors"] += 1
+        metrics.inc("wcgr_errors_total", type="shared_state")
+        print(f"Shared state {operation} error: {exc!r}")
+
+    async def close(self):
+        pass
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, backend=self.backend)
+
+class SQLiteSharedState(SharedState):
+    backend = "sqlite"
+    # Expired rows are swept every this many writes, and whenever over budget
+    EVICT_EVERY = 256
+    # Only cache entries are evicted to stay under SHARED_STATE_MAX_BYTES; rate-limit
+    # counters and breakers are small and must live out their TTL
+    EVICTABLE = "forecast:"
+
+    def __init__(self, path: str, prefix: str):
+        super().__init__(prefix)
+        self.path = path
+        self.max_bytes = int(get_env_var("SHARED_STATE_MAX_BYTES", str(64 * 1024 * 1024)))
+        self.timeout = float(get_env_var("SHARED_STATE_TIMEOUT", "0.1"))
+        self._conn = None
+        self._executor = None
+        self._pid = None
+        self._writes = 0
+
+    async def _run(self, fn, *args):
+        # sqlite3 blocks: every call goes to one thread per process, which also
+        # owns the connection, so statements never run concurrently
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+            self._conn, self._pid = None, os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _db(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={self.max_bytes * 2}")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS shared_kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS shared_kv_expires_at ON shared_kv (expires_at)")
+            # Running total of stored bytes, kept by triggers so that every worker sees the same figure
+            conn.execute("CREATE TABLE IF NOT EXISTS shared_kv_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO shared_kv_size SELECT 0, COALESCE(SUM(length(value)), 0) FROM shared_kv")
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS shared_kv_size_insert AFTER INSERT ON shared_kv BEGIN "
+                "UPDATE shared_kv_size SET bytes = bytes + length(NEW.value); END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS shared_kv_size_update AFTER UPDATE OF value ON shared_kv BEGIN "
+                "UPDATE shared_kv_size SET bytes = bytes + length(NEW.value) - length(OLD.value); END"
+            )
+            conn.execute(
+                "CREATE TRIGGER IF NOT EXISTS shared_kv_size_delete AFTER DELETE ON shared_kv BEGIN "
+                "UPDATE shared_kv_size SET bytes = bytes - length(OLD.value); END"
+            )
+            conn.execute("COMMIT")
+            self._conn = conn
+        return self._conn
+
+    def _get_sync(self, key: str):
+        row = self._db().execute(
+            "SELECT value FROM shared_kv WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def _set_sync(self, key: str, value: bytes, ttl: float):
+        self._db().execute(
+            "INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at",
+            (key, value, time.time() + ttl),
+        )
+        self._wrote(key)
+
+    def _delete_sync(self, key: str):
+        self._db().execute("DELETE FROM shared_kv WHERE key = ?", (key,))
+
+    def _incr_sync(self, key: str, amount: int, ttl: float):
+        now = time.time()
+        row = self._db().execute(
+            "INSERT INTO shared_kv (key, value, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET "
+            "value = CASE WHEN expires_at <= ? THEN excluded.value ELSE value + excluded.value END, "
+            "expires_at = CASE WHEN expires_at <= ? THEN excluded.expires_at ELSE expires_at END "
+            "RETURNING value",
+            (key, amount, now + ttl, now, now),
+        ).fetchone()
+        self._wrote(key)
+        return row[0]
+
+    async def _get(self, key: str):
+        return await self._run(self._get_sync, key)
+
+    async def _set(self, key: str, value: bytes, ttl: float):
+        await self._run(self._set_sync, key, value, ttl)
+
+    async def _delete(self, key: str):
+        await self._run(self._delete_sync, key)
+
+    async def _incr(self, key: str, amount: int, ttl: float):
+        return await self._run(self._incr_sync, key, amount, ttl)
+
+    def _excess(self) -> int:
+        return self._db().execute("SELECT bytes FROM shared_kv_size").fetchone()[0] - self.max_bytes
+
+    def _wrote(self, key: str):
+        self._writes += 1
+        db = self._db()
+        excess = self._excess()
+        if excess <= 0 and self._writes % self.EVICT_EVERY:
+            return
+        db.execute("DELETE FROM shared_kv WHERE expires_at <= ?", (time.time(),))
+        excess = self._excess()
+        if excess <= 0:
+            return
+        # Still over budget: drop just enough of the oldest cache entries (they all
+        # share one TTL, so the earliest expiry is the oldest write), never the one
+        # that was just written
+        namespace = self.prefix + self.EVICTABLE
+        rows = db.execute(
+            "SELECT key, length(value) FROM shared_kv WHERE substr(key, 1, ?) = ? AND key <> ? "
+            "ORDER BY expires_at LIMIT ?",
+            (len(namespace), namespace, key, self.EVICT_EVERY),
+        ).fetchall()
+        victims = []
+        for victim, size in rows:
+            if excess <= 0:
+                break
+            victims.append((victim,))
+            excess -= size
+        db.executemany("DELETE FROM shared_kv WHERE key = ?", victims)
+
+    def _close_sync(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = None
+
+    async def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            await self._run(self._close_sync)
+            self._executor.shutdown(wait=False)
+        self._executor = None
+
+class RedisError(Exception):
+    pass
+
+class RedisSharedState(SharedState):
+    backend = "redis"
+
+    def __init__(self, url: str, prefix: str):
+        super().__init__(prefix)
+        parsed = urllib.parse.urlsplit(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = urllib.parse.unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = float(get_env_var("SHARED_STATE_TIMEOUT", "0.1"))
+        # At most this many connections; bursts queue for one instead of
+        # opening a connection per request
+        self._slots = asyncio.Semaphore(int(get_env_var("SHARED_STATE_POOL_SIZE", "16")))
+        self._idle = []
+
+    async def _open(self):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), timeout=self.timeout)
+        connection = (reader, writer)
+        if self.password:
+            await self._roundtrip(connection, "AUTH", self.password)
+        if self.db:
+            await self._roundtrip(connection, "SELECT", self.db)
+        return connection
+
+    @staticmethod
+    def _encode(args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(parts)
+
+    async def _read_reply(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            return RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(length)]
+        raise RedisError(f"unexpected reply {line!r}")
+
+    async def _roundtrip(self, connection, *args):
+        reader, writer = connection
+        writer.write(self._encode(args))
+        reply = await asyncio.wait_for(self._read_reply(reader), timeout=self.timeout)
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    async def _command(self, *args):
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else await self._open()
             try:
-                cursor = conn.cursor()
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS queries (
-                        id SERIAL PRIMARY KEY,
-                        user_text TEXT NOT NULL,
-                        horizon VARCHAR(50),
-                        severity VARCHAR(50),
-                        model_used VARCHAR(100),
-                        response_preview TEXT,
-                        ip_address VARCHAR(45),
-                        created_at TIMESTAMPTZ DEFAULT NOW()
-                    );
-                    -- Add ip_address column if it doesn't exist (for existing tables)
-                    DO $$
-                    BEGIN
-                        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='queries' AND column_name='ip_address') THEN
-                            ALTER TABLE queries ADD COLUMN ip_address VARCHAR(45);
-                        END IF;
-                    END
-                    $$;
-                """)
-                conn.commit()
-                cursor.close()
-                print("Database table initialized successfully")
-            except Exception as e:
-                print(f"Database initialization error: {e}")
+                reply = await self._roundtrip(connection, *args)
+            except RedisError:
+                self._idle.append(connection)
+                raise
+            except BaseException:
+                # The reply may still be in flight: the connection can't be reused
+                connection[1].close()
+                raise
+            self._idle.append(connection)
+            return reply
+
+    async def _get(self, key: str):
+        return await self._command("GET", key)
+
+    async def _set(self, key: str, value: bytes, ttl: float):
+        await self._command("SET", key, value, "PX", max(1, int(ttl * 1000)))
+
+    async def _delete(self, key: str):
+        await self._command("DEL", key)
+
+    async def _incr(self, key: str, amount: int, ttl: float):
+        value = await self._command("INCRBY", key, amount)
+        if value == amount:
+            # First increment created the key: it expires like every other entry
+            await self._command("PEXPIRE", key, max(1, int(ttl * 1000)))
+        return value
+
+    async def close(self):
+        while self._idle:
+            self._idle.pop()[1].close()
+
+def create_shared_state():
+    url = get_env_var("SHARED_STATE_URL")
+    prefix = get_env_var("SHARED_STATE_PREFIX", "wcgr:")
+    if not url:
+        return None
+    if url.startswith("sqlite:"):
+        path = url[len("sqlite://"):] if url.startswith("sqlite://") else url[len("sqlite:"):]
+        return SQLiteSharedState(path or os.path.join(tempfile.gettempdir(), "wcgr-shared-state.db"), prefix)
+    if url.startswith(("redis://", "rediss://")):
+        if url.startswith("rediss://"):
+            print("SHARED_STATE_URL: TLS (rediss://) is not supported, falling back to per-worker state")
+            return None
+        return RedisSharedState(url, prefix)
+    print(f"SHARED_STATE_URL: unsupported scheme in {url.split(':', 1)[0]!r}, falling back to per-worker state")
+    return None
+
+shared_state = create_shared_state()
+_background_tasks = set()
+
+def spawn(coro):
+    """Fire-and-forget for shared-state writes made from synchronous code."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Breakers opened by one worker are picked up by the others on the next sync
+_shared_sync_task = None
+
+async def _sync_shared_state(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        for name, health in provider_health.items():
+            value = await shared_state.get(f"breaker:{name}")
+            if value is not None:
+                health.adopt_open_until(float(value))
+
+def start_shared_state_sync():
+    global _shared_sync_task
+    interval = float(get_env_var("SHARED_STATE_SYNC_INTERVAL", "1"))
+    if shared_state is not None and interval > 0 and (_shared_sync_task is None or _shared_sync_task.done()):
+        _shared_sync_task = asyncio.create_task(_sync_shared_state(interval))
+
+# Static frontend
+# index.html is read once and kept in memory together with gzip (and brotli, when
+# the optional `brotli` package is installed) variants. The file is re-read only
+# when its mtime changes, checked at most every FRONTEND_RELOAD_INTERVAL seconds.
+class FrontendAsset:
+    def __init__(self):
+        self.reload_interval = float(get_env_var("FRONTEND_RELOAD_INTERVAL", "2"))
+        self.cache_control = get_env_var("FRONTEND_CACHE_CONTROL", "no-cache")
+        self.path = None
+        self.variants = {}
+        self._mtime = None
+        self._checked_at = 0.0
+
+    def _find_path(self):
+        # Try to read index.html from the root directory
+        # In Vercel serverless, the root of the project is often the cwd or /var/task
+        for path in (os.path.join(os.getcwd(), "index.html"), os.path.join(os.getcwd(), "..", "index.html")):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _load(self, mtime: float):
+        with open(self.path, "rb") as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        variants = {"identity": (body, f'"{digest}"')}
+        variants["gzip"] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+        if brotli is not None:
+            variants["br"] = (brotli.compress(body, quality=11), f'"{digest}-br"')
+        self.variants = variants
+        self._mtime = mtime
+
+    def refresh(self) -> bool:
+        now = time.monotonic()
+        if self.variants and now - self._checked_at < self.reload_interval:
+            return True
+        self._checked_at = now
+        if self.path is None:
+            self.path = self._find_path()
+            if self.path is None:
+                return False
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self._mtime:
+            self._load(mtime)
+        return True
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = {}
+        for part in accept_encoding.split(","):
+            name, _, params = part.strip().partition(";")
+            q = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    q = float(params.strip()[2:])
+                except ValueError:
+                    q = 0.0
+            accepted[name.strip().lower()] = q
+        for encoding in ("br", "gzip"):
+            if encoding in self.variants and accepted.get(encoding, accepted.get("*", 0)) > 0:
+                return encoding
+        return "identity"
+
+frontend_asset = FrontendAsset()
 
 # serve index.html if possible
 @app.get("/")
-async def root():
+async def root(request: Request):
     try:
-        # Try to read index.html from the root directory
-        # In Vercel serverless, the root of the project is often the cwd or /var/task
-        path = os.path.join(os.getcwd(), "index.html")
-        if not os.path.exists(path):
-            # Try one level up if we are in /api
-            path = os.path.join(os.getcwd(), "..", "index.html")
-        
-        if os.path.exists(path):
-            with open(path, "r") as f:
-                return HTMLResponse(content=f.read())
-        return HTMLResponse(content="<h1>WCGR API Active</h1><p>Frontend file not found. Check deployment structure.</p>")
+        if not frontend_asset.refresh():
+            return HTMLResponse(content="<h1>WCGR API Active</h1><p>Frontend file not found. Check deployment structure.</p>")
+
+        encoding = frontend_asset.negotiate(request.headers.get("accept-encoding", ""))
+        body, etag = frontend_asset.variants[encoding]
+        headers = {"ETag": etag, "Cache-Control": frontend_asset.cache_control, "Vary": "Accept-Encoding"}
+
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="text/html; charset=utf-8", headers=headers)
     except Exception as e:
         return HTMLResponse(content=f"<h1>Error</h1><p>{str(e)}</p>")
 
@@ -92,18 +1295,182 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def get_env_var(key: str, default: str = "") -> str:
-    return os.environ.get(key, default).strip()
+# Times the first HTTP request this process serves (until its response headers),
+# then gets out of the way: a plain ASGI wrapper, no per-request work afterwards.
+class ColdStartTimer:
+    def __init__(self, app):
+        self.app = app
+        self._timing = False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self._timing or cold_start["first_request_seconds"] is not None:
+            await self.app(scope, receive, send)
+            return
+        self._timing = True
+        start = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start" and cold_start["first_request_seconds"] is None:
+                now = time.perf_counter()
+                cold_start["first_request_seconds"] = now - start
+                cold_start["first_response_after_import_seconds"] = now - _IMPORT_STARTED
+            await send(message)
+
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            self._timing = False
+
+app.add_middleware(ColdStartTimer)
+
+# Shared async HTTP transport for provider streams.
+# One client per worker keeps TLS connections alive per provider host, so
+# streams never block the event loop and don't redo the handshake each time.
+_http_client = None
+
+class UpstreamHTTPError(Exception):
+    def __init__(self, status_code: int, reason: str, body: str = ""):
+        self.status_code = status_code
+        self.reason = reason
+        self.body = body
+        super().__init__(f"HTTP Error {status_code}: {reason}")
+
+def get_http_client() -> "httpx.AsyncClient":
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        import httpx
+        limits = httpx.Limits(
+            max_connections=int(get_env_var("HTTP_MAX_CONNECTIONS", "500")),
+            max_keepalive_connections=int(get_env_var("HTTP_MAX_KEEPALIVE", "100")),
+            keepalive_expiry=float(get_env_var("HTTP_KEEPALIVE_EXPIRY", "60")),
+        )
+        _http_client = httpx.AsyncClient(
+            limits=limits,
+            timeout=httpx.Timeout(
+                float(get_env_var("PROVIDER_TIMEOUT", "45")),
+                connect=float(get_env_var("PROVIDER_CONNECT_TIMEOUT", "10")),
+            ),
+            headers={"User-Agent": "WCGR-Vercel/1.0"},
+        )
+    return _http_client
+
+# Per-request deadlines
+# Each prediction gets one budget, shared by its failover and hedge attempts:
+# PROVIDER_CONNECT_TIMEOUT seconds per attempt until the upstream response headers
+# arrive, PROVIDER_FIRST_TOKEN_TIMEOUT from there until the first streamed text
+# (keep-alives such as Anthropic's message_start and ping events don't count),
+# and PROVIDER_TIMEOUT in total from when the request was accepted.
+class DeadlineExceeded(Exception):
+    def __init__(self, phase: str):
+        self.phase = phase
+        super().__init__(f"Upstream {phase.replace('_', ' ')} deadline exceeded")
+
+class Deadline:
+    def __init__(self):
+        self.connect = float(get_env_var("PROVIDER_CONNECT_TIMEOUT", "10"))
+        self.first_token = float(get_env_var("PROVIDER_FIRST_TOKEN_TIMEOUT", "20"))
+        self.total = float(get_env_var("PROVIDER_TIMEOUT", "45"))
+        self.expires_at = time.monotonic() + self.total
+
+    def phase(self, name: str, started: float):
+        """(phase, seconds left) for a phase that began at `started`, capped by the total."""
+        ends_at = started + getattr(self, name)
+        if ends_at >= self.expires_at:
+            return "total", self.expires_at - time.monotonic()
+        return name, ends_at - time.monotonic()
+
+def upstream_error(exc: Exception) -> dict:
+    if isinstance(exc, DeadlineExceeded):
+        return {'error': str(exc), 'deadline': exc.phase}
+    return {'error': str(exc)}
+
+# Marks the end of the connect phase in the line queue below
+_HEADERS_RECEIVED = object()
+
+async def _sse_text(url: str, body: dict, headers: dict, provider: str, parse, deadline: Deadline = None) -> AsyncGenerator[str, None]:
+    """POST a JSON body and yield the text that `parse` extracts from each `data: `
+    line of the SSE response (lines it returns nothing for are skipped).
+
+    The HTTP exchange runs in its own task feeding a queue, so a deadline timer
+    can cut it off (and close the connection) wherever it happens to be waiting."""
+    deadline = deadline or Deadline()
+    loop = asyncio.get_running_loop()
+    lines = asyncio.Queue()
+
+    async def read():
+        client = get_http_client()
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", url, json=body, headers=headers) as resp:
+                metrics.observe("wcgr_upstream_connect_seconds", time.perf_counter() - start, provider=provider)
+                if resp.status_code >= 400:
+                    error_body = (await resp.aread()).decode("utf-8", "replace")
+                    raise UpstreamHTTPError(resp.status_code, resp.reason_phrase, error_body)
+                lines.put_nowait(_HEADERS_RECEIVED)
+                async for line in resp.aiter_lines():
+                    line = line.strip()
+                    if line.startswith("data: "):
+                        lines.put_nowait(line[6:])
+            lines.put_nowait(None)
+        except Exception as e:
+            lines.put_nowait(e)
+
+    def expire(phase: str):
+        reader.cancel()
+        lines.put_nowait(DeadlineExceeded(phase))
+
+    def arm(name: str):
+        phase, remaining = deadline.phase(name, time.monotonic())
+        return loop.call_later(max(0.0, remaining), expire, phase)
+
+    reader = asyncio.create_task(read())
+    timer = arm("connect")
+    streaming = False
+    try:
+        while True:
+            item = await lines.get()
+            if item is None:
+                return
+            if item is _HEADERS_RECEIVED:
+                timer.cancel()
+                timer = arm("first_token")
+                continue
+            if isinstance(item, Exception):
+                metrics.inc("wcgr_errors_total", type=error_type(item), provider=provider)
+                raise item
+            if item == "[DONE]":
+                return
+            text = parse(item)
+            if not text:
+                continue
+            if not streaming:
+                streaming = True
+                timer.cancel()
+                timer = loop.call_later(max(0.0, deadline.expires_at - time.monotonic()), expire, "total")
+            yield text
+    finally:
+        timer.cancel()
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
 
-async def _gemini_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]:
+async def _gemini_stream(prompt: str, config: dict) -> AsyncGenerator[dict, None]:
     api_key = get_env_var("GEMINI_API_KEY")
     if not api_key:
-        yield f"data: {json.dumps({'error': 'Missing GEMINI_API_KEY'})}\n\n"
+        yield {'error': 'Missing GEMINI_API_KEY'}
         return
 
     model = get_env_var("GEMINI_MODEL", "gemini-2.0-flash")
+    base_url = get_env_var("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta").rstrip("/")
     url = (
-        f"https://generativelanguage.googleapis.com/v1beta/models/{urllib.parse.quote(model)}:streamGenerateContent?alt=sse&key={urllib.parse.quote(api_key)}"
+        f"{base_url}/models/{urllib.parse.quote(model)}:streamGenerateContent?alt=sse&key={urllib.parse.quote(api_key)}"
     )
 
     req_body = {
@@ -114,31 +1481,24 @@ async def _gemini_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]
         },
     }
 
-    req = urllib.request.Request(
-        url,
-        data=json.dumps(req_body).encode("utf-8"),
-        headers={"Content-Type": "application/json", "User-Agent": "WCGR-Vercel/1.0"},
-        method="POST",
-    )
+    headers = {"Content-Type": "application/json", "User-Agent": "WCGR-Vercel/1.0"}
 
     try:
-        with urllib.request.urlopen(req, timeout=45) as resp:
-            for line in resp:
-                line = line.decode("utf-8").strip()
-                if line.startswith("data: "):
-                    data = json.loads(line[6:])
-                    parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
-                    text = "".join(p.get("text", "") for p in parts if "text" in p)
-                    if text:
-                        yield f"data: {json.dumps({'output': text})}\n\n"
+        async for text in _sse_text(url, req_body, headers, "gemini", _gemini_text, config.get("deadline")):
+            yield {'output': text}
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield upstream_error(e)
+
+def _gemini_text(payload: str):
+    data = json.loads(payload)
+    parts = data.get("candidates", [{}])[0].get("content", {}).get("parts", [])
+    return "".join(p.get("text", "") for p in parts if "text" in p)
 
-async def _openai_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]:
+async def _openai_stream(prompt: str, config: dict) -> AsyncGenerator[dict, None]:
     api_key = get_env_var("OPENAI_API_KEY")
     base_url = get_env_var("OPENAI_BASE_URL")
     if not api_key and not base_url:
-        yield f"data: {json.dumps({'error': 'Missing API Credentials'})}\n\n"
+        yield {'error': 'Missing API Credentials'}
         return
 
     model = get_env_var("OPENAI_MODEL", "llama-3.3-70b-versatile")
@@ -159,26 +1519,20 @@ async def _openai_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]
     if api_key:
         headers["Authorization"] = f"Bearer {api_key}"
 
-    req = urllib.request.Request(url=endpoint, data=json.dumps(req_body).encode("utf-8"), headers=headers, method="POST")
-
     try:
-        with urllib.request.urlopen(req, timeout=45) as resp:
-            for line in resp:
-                line = line.decode("utf-8").strip()
-                if line.startswith("data: "):
-                    if line == "data: [DONE]":
-                        break
-                    data = json.loads(line[6:])
-                    delta = data.get("choices", [{}])[0].get("delta", {})
-                    if "content" in delta:
-                        yield f"data: {json.dumps({'output': delta['content']})}\n\n"
+        async for text in _sse_text(endpoint, req_body, headers, "openai", _chat_completion_text, config.get("deadline")):
+            yield {'output': text}
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield upstream_error(e)
+
+def _chat_completion_text(payload: str):
+    data = json.loads(payload)
+    return data.get("choices", [{}])[0].get("delta", {}).get("content")
 
-async def _anthropic_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]:
+async def _anthropic_stream(prompt: str, config: dict) -> AsyncGenerator[dict, None]:
     api_key = get_env_var("ANTHROPIC_API_KEY")
     if not api_key:
-        yield f"data: {json.dumps({'error': 'Missing ANTHROPIC_API_KEY'})}\n\n"
+        yield {'error': 'Missing ANTHROPIC_API_KEY'}
         return
 
     model = get_env_var("ANTHROPIC_MODEL", "claude-3-5-sonnet-20240620")
@@ -198,30 +1552,28 @@ async def _anthropic_stream(prompt: str, config: dict) -> AsyncGenerator[str, No
         "User-Agent": "WCGR-Vercel/1.0",
     }
 
-    req = urllib.request.Request(
-        url="https://api.anthropic.com/v1/messages", data=json.dumps(req_body).encode("utf-8"), headers=headers, method="POST"
-    )
+    endpoint = get_env_var("ANTHROPIC_BASE_URL", "https://api.anthropic.com/v1").rstrip("/") + "/messages"
 
     try:
-        with urllib.request.urlopen(req, timeout=45) as resp:
-            for line in resp:
-                line = line.decode("utf-8").strip()
-                if line.startswith("data: "):
-                    data = json.loads(line[6:])
-                    if data.get("type") == "content_block_delta":
-                        text = data.get("delta", {}).get("text", "")
-                        yield f"data: {json.dumps({'output': text})}\n\n"
+        async for text in _sse_text(endpoint, req_body, headers, "anthropic", _anthropic_text, config.get("deadline")):
+            yield {'output': text}
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield upstream_error(e)
+
+def _anthropic_text(payload: str):
+    data = json.loads(payload)
+    if data.get("type") == "content_block_delta":
+        return data.get("delta", {}).get("text", "")
+    return None
 
-async def _groq_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]:
+async def _groq_stream(prompt: str, config: dict) -> AsyncGenerator[dict, None]:
     api_key = get_env_var("GROQ_API_KEY")
     if not api_key:
-        yield f"data: {json.dumps({'error': 'Missing GROQ_API_KEY'})}\n\n"
+        yield {'error': 'Missing GROQ_API_KEY'}
         return
 
     model = get_env_var("GROQ_MODEL", "llama-3.3-70b-versatile")
-    endpoint = "https://api.groq.com/openai/v1/chat/completions"
+    endpoint = get_env_var("GROQ_BASE_URL", "https://api.groq.com/openai/v1").rstrip("/") + "/chat/completions"
 
     req_body = {
         "model": model,
@@ -237,21 +1589,923 @@ async def _groq_stream(prompt: str, config: dict) -> AsyncGenerator[str, None]:
         "User-Agent": "WCGR-Vercel/1.0",
     }
 
-    req = urllib.request.Request(url=endpoint, data=json.dumps(req_body).encode("utf-8"), headers=headers, method="POST")
-
     try:
-        with urllib.request.urlopen(req, timeout=45) as resp:
-            for line in resp:
-                line = line.decode("utf-8").strip()
-                if line.startswith("data: "):
-                    if line == "data: [DONE]":
-                        break
-                    data = json.loads(line[6:])
-                    delta = data.get("choices", [{}])[0].get("delta", {})
-                    if "content" in delta:
-                        yield f"data: {json.dumps({'output': delta['content']})}\n\n"
+        async for text in _sse_text(endpoint, req_body, headers, "groq", _chat_completion_text, config.get("deadline")):
+            yield {'output': text}
     except Exception as e:
-        yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        yield upstream_error(e)
+
+PROVIDER_STREAMS = {
+    "gemini": _gemini_stream,
+    "openai": _openai_stream,
+    "anthropic": _anthropic_stream,
+    "groq": _groq_stream,
+}
+
+def provider_model(provider: str) -> str:
+    if provider == "openai":
+        return get_env_var("OPENAI_MODEL", "llama-3.3-70b-versatile")
+    if provider == "anthropic":
+        return get_env_var("ANTHROPIC_MODEL", "claude-3-5-sonnet-20240620")
+    if provider == "groq":
+        return get_env_var("GROQ_MODEL", "llama-3.3-70b-versatile")
+    return get_env_var("GEMINI_MODEL", "gemini-2.0-flash")
+
+def provider_has_key(provider: str) -> bool:
+    if provider == "openai":
+        return bool(get_env_var("OPENAI_API_KEY")) or bool(get_env_var("OPENAI_BASE_URL"))
+    if provider == "anthropic":
+        return bool(get_env_var("ANTHROPIC_API_KEY"))
+    if provider == "groq":
+        return bool(get_env_var("GROQ_API_KEY"))
+    return bool(get_env_var("GEMINI_API_KEY"))
+
+# Provider health tracking and circuit breaker
+# Every provider stream feeds EWMA latency, time-to-first-token and error rate.
+# A breaker opens after BREAKER_FAILURE_THRESHOLD consecutive failures (or when
+# the error rate EWMA passes BREAKER_ERROR_RATE), stays open for
+# BREAKER_COOLDOWN seconds and then goes half-open: a single probe request is
+# let through while everything else keeps going to the fallbacks, and the probe's
+# success closes the breaker, its failure opens it again.
+class ProviderHealth:
+    def __init__(self, name: str):
+        self.name = name
+        self.alpha = float(get_env_var("HEALTH_EWMA_ALPHA", "0.2"))
+        self.failure_threshold = int(get_env_var("BREAKER_FAILURE_THRESHOLD", "5"))
+        self.error_rate_threshold = float(get_env_var("BREAKER_ERROR_RATE", "0.5"))
+        self.min_requests = int(get_env_var("BREAKER_MIN_REQUESTS", "10"))
+        self.cooldown = float(get_env_var("BREAKER_COOLDOWN", "30"))
+        self.latency_ewma = None
+        self.ttft_ewma = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.last_error = None
+        # When the half-open probe was admitted (None: no probe in flight). It is
+        # claimed right before the upstream request; should that request never report
+        # back, the claim lapses after the stream deadline.
+        self.probe_started = None
+        self.probe_timeout = float(get_env_var("PROVIDER_TIMEOUT", "45"))
+
+    def _ewma(self, current, value):
+        return value if current is None else current + self.alpha * (value - current)
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and self.probe_started is not None:
+            return time.monotonic() - self.probe_started >= self.probe_timeout
+        return self.state != "open"
+
+    def admit(self) -> bool:
+        """available(), and when half-open also claim the single probe."""
+        if not self.available():
+            return False
+        if self.state == "half_open":
+            self.probe_started = time.monotonic()
+        return True
+
+    def release_probe(self):
+        """The probe ended without a verdict (cancelled or turned away locally)."""
+        self.probe_started = None
+
+    def record_success(self, ttft, duration: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.error_rate = self._ewma(self.error_rate, 0.0)
+        self.latency_ewma = self._ewma(self.latency_ewma, duration)
+        if ttft is not None:
+            self.ttft_ewma = self._ewma(self.ttft_ewma, ttft)
+        self.probe_started = None
+        if self.state == "half_open" and shared_state is not None:
+            spawn(shared_state.delete(f"breaker:{self.name}"))
+        self.state = "closed"
+
+    def record_failure(self, error: str, duration: float):
+        self.requests += 1
+        self.errors += 1
+        self.consecutive_failures += 1
+        self.error_rate = self._ewma(self.error_rate, 1.0)
+        self.latency_ewma = self._ewma(self.latency_ewma, duration)
+        self.last_error = error
+        self.probe_started = None
+        sustained = self.requests >= self.min_requests and self.error_rate >= self.error_rate_threshold
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold or sustained:
+            if self.state != "open":
+                print(f"Circuit breaker opened for {self.name}: {error}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            if shared_state is not None:
+                spawn(shared_state.set(f"breaker:{self.name}", str(time.time() + self.cooldown).encode(), self.cooldown))
+
+    def adopt_open_until(self, open_until: float):
+        """Open the breaker because another worker did, until the same wall-clock time."""
+        remaining = open_until - time.time()
+        if remaining > 0 and self.state != "open":
+            print(f"Circuit breaker opened for {self.name} by another worker")
+            self.state = "open"
+            self.probe_started = None
+            self.opened_at = time.monotonic() - (self.cooldown - remaining)
+
+    def snapshot(self) -> dict:
+        self.available()
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "errorRate": round(self.error_rate, 4),
+            "latencyEwma": self.latency_ewma,
+            "ttftEwma": self.ttft_ewma,
+            "lastError": self.last_error,
+        }
+
+provider_health = {name: ProviderHealth(name) for name in PROVIDER_STREAMS}
+
+def provider_route(primary: str) -> list:
+    """Primary provider followed by the fallbacks, in the order they should be tried."""
+    fallbacks = [name.strip().lower() for name in get_env_var("LLM_FALLBACK_PROVIDERS").split(",") if name.strip()]
+    if not fallbacks:
+        fallbacks = [name for name in PROVIDER_STREAMS if provider_has_key(name)]
+    route = [primary]
+    for name in fallbacks:
+        if name in PROVIDER_STREAMS and name not in route:
+            route.append(name)
+    return route
+
+def select_provider(primary: str):
+    """First provider on the route that would be let through, without claiming a probe."""
+    for name in provider_route(primary):
+        if provider_health[name].available():
+            return name
+    return None
+
+def claim_provider(primary: str):
+    """select_provider() for a request that goes upstream now: claims the half-open
+    probe, or falls back if another request claimed it since the selection."""
+    for name in provider_route(primary):
+        if provider_health[name].admit():
+            return name
+    return None
+
+# Admission control
+# Each client IP gets a token bucket (RATE_LIMIT_RPS refill, RATE_LIMIT_BURST
+# capacity), and each provider allows PROVIDER_MAX_CONCURRENCY concurrent upstream
+# streams with at most PROVIDER_MAX_QUEUE more waiting for a slot. Anything past
+# that is answered with a 429 and Retry-After instead of queueing indefinitely.
+class RateLimiter:
+    def __init__(self):
+        self.rate = float(get_env_var("RATE_LIMIT_RPS", "1"))
+        self.burst = float(get_env_var("RATE_LIMIT_BURST", "10"))
+        self.max_clients = int(get_env_var("RATE_LIMIT_MAX_CLIENTS", "100000"))
+        self._buckets = OrderedDict()
+        self.stats = {"allowed": 0, "limited": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and self.burst > 0
+
+    async def acquire(self, key: str, cost: float = 1.0) -> float:
+        """Take cost tokens from key's bucket. Returns 0 when allowed, otherwise
+        the seconds until enough tokens will have refilled."""
+        if not self.enabled:
+            return 0.0
+        if shared_state is not None:
+            wait = await self._acquire_shared(key, cost)
+            if wait is not None:
+                return wait
+        return self._acquire_local(key, cost)
+
+    async def _acquire_shared(self, key: str, cost: float):
+        # Across workers the bucket becomes a fixed window of RATE_LIMIT_BURST
+        # requests per BURST / RPS seconds: one atomic increment per request.
+        window = self.burst / self.rate
+        now = time.time()
+        index = int(now // window)
+        count = await shared_state.incr(f"ratelimit:{key}:{index}", math.ceil(cost), window * 2)
+        if count is None:
+            return None
+        if count <= self.burst:
+            self.stats["allowed"] += 1
+            return 0.0
+        self.stats["limited"] += 1
+        return (index + 1) * window - now
+
+    def _acquire_local(self, key: str, cost: float) -> float:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+        wait = 0.0
+        if tokens >= cost:
+            tokens -= cost
+            self.stats["allowed"] += 1
+        else:
+            wait = (cost - tokens) / self.rate
+            self.stats["limited"] += 1
+        self._buckets[key] = (tokens, now)
+        # Least recently seen clients go first; their buckets would be full again anyway
+        while len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, clients=len(self._buckets))
+
+class ProviderLimiter:
+    def __init__(self, name: str):
+        self.name = name
+        self.max_concurrency = int(get_env_var("PROVIDER_MAX_CONCURRENCY", "32"))
+        self.max_queue = int(get_env_var("PROVIDER_MAX_QUEUE", "64"))
+        self.queue_timeout = float(get_env_var("PROVIDER_QUEUE_TIMEOUT", "10"))
+        self.active = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        self.stats = {"admitted": 0, "rejected": 0, "timeouts": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0
+
+    def saturated(self) -> bool:
+        return self.enabled and self.active >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def retry_after(self) -> float:
+        # A slot frees up roughly once per typical stream duration
+        return provider_health[self.name].latency_ewma or 1.0
+
+    async def acquire(self) -> bool:
+        if not self.enabled:
+            return True
+        if self.saturated():
+            self.stats["rejected"] += 1
+            return False
+        self.waiting += 1
+        try:
+            if self._semaphore.locked():
+                await asyncio.wait_for(self._semaphore.acquire(), timeout=self.queue_timeout)
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            return False
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        self.stats["admitted"] += 1
+        return True
+
+    def release(self):
+        if self.enabled:
+            self.active -= 1
+            self._semaphore.release()
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, active=self.active, waiting=self.waiting)
+
+rate_limiter = RateLimiter()
+provider_limits = {name: ProviderLimiter(name) for name in PROVIDER_STREAMS}
+
+def too_many_requests(message: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"error": message},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+async def provider_stream(provider: str, prompt: str, config: dict) -> AsyncGenerator[dict, None]:
+    stream = PROVIDER_STREAMS.get(provider, _gemini_stream)
+    health = provider_health.get(provider, provider_health["gemini"])
+    labels = {"provider": provider, "model": provider_model(provider)}
+    limiter = provider_limits.get(provider, provider_limits["gemini"])
+    if not await limiter.acquire():
+        # Local overload, not a provider fault: the breaker is left alone
+        health.release_probe()
+        metrics.inc("wcgr_rejected_total", reason="provider_queue", provider=provider)
+        yield {'error': f"{provider} is at capacity, try again shortly"}
+        return
+    start = time.monotonic()
+    ttft = None
+    chunks = 0
+    error = None
+    # Why the stream stopped early, if it did: a deadline phase, "hedge_lost" (the
+    # message hedged_stream cancels losers with) or "client_disconnect"
+    cancelled = None
+    metrics.inc("wcgr_streams_in_flight", **labels)
+    try:
+        try:
+            async for event in stream(prompt, config):
+                if 'error' in event:
+                    error = event['error']
+                    if 'deadline' in event:
+                        cancelled = f"deadline_{event['deadline']}"
+                elif event.get('output'):
+                    chunks += 1
+                    if ttft is None:
+                        ttft = time.monotonic() - start
+                yield event
+        except asyncio.CancelledError as e:
+            cancelled = e.args[0] if e.args and e.args[0] else "client_disconnect"
+            raise
+        except GeneratorExit:
+            cancelled = "client_disconnect"
+            raise
+        except Exception as e:
+            error = str(e)
+            yield {'error': error}
+    finally:
+        metrics.inc("wcgr_streams_in_flight", -1, **labels)
+        limiter.release()
+        if cancelled is not None:
+            if not cancelled.startswith("deadline_"):
+                health.release_probe()
+            elapsed = time.monotonic() - start
+            print(f"Upstream {provider} stream cancelled ({cancelled}) after {elapsed:.2f}s and {chunks} chunks")
+            metrics.inc("wcgr_streams_cancelled_total", reason=cancelled, **labels)
+            metrics.observe("wcgr_cancelled_stream_seconds", elapsed, reason=cancelled, provider=provider)
+    # Streams abandoned by the client never get here and are not counted either way
+    duration = time.monotonic() - start
+    metrics.observe("wcgr_stream_duration_seconds", duration, **labels)
+    if error is None:
+        health.record_success(ttft, duration)
+        metrics.inc("wcgr_streams_total", outcome="ok", **labels)
+        if ttft is not None:
+            metrics.observe("wcgr_ttft_seconds", ttft, **labels)
+            if duration > ttft:
+                metrics.observe("wcgr_stream_chunks_per_second", chunks / (duration - ttft), **labels)
+    else:
+        health.record_failure(error, duration)
+        metrics.inc("wcgr_streams_total", outcome="error", **labels)
+
+def dumps(obj) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+def sse_event(event: dict, event_id: str = None) -> str:
+    if event_id is not None:
+        return f"id: {event_id}\ndata: {dumps(event)}\n\n"
+    return f"data: {dumps(event)}\n\n"
+
+# SSE frame coalescing
+# Providers often stream one token per delta. Consecutive output deltas are merged
+# into a single frame per SSE_COALESCE_MS window, or sooner once SSE_COALESCE_BYTES
+# of text is buffered. Any other event flushes the buffer and passes through as is.
+# The first text delta is never held back.
+SSE_FRAME_OVERHEAD = len(sse_event({'output': ''}))
+sse_stats = {"events_in": 0, "frames_out": 0, "frames_saved": 0, "bytes_saved": 0}
+
+async def coalesce_events(events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    window = float(get_env_var("SSE_COALESCE_MS", "40")) / 1000
+    max_bytes = int(get_env_var("SSE_COALESCE_BYTES", "2048"))
+    if window <= 0:
+        async for event in events:
+            yield event
+        return
+
+    queue = asyncio.Queue()
+
+    async def pump():
+        try:
+            async for event in events:
+                queue.put_nowait(event)
+        finally:
+            queue.put_nowait(None)
+
+    def flush():
+        sse_stats["events_in"] += len(buffer)
+        sse_stats["frames_out"] += 1
+        sse_stats["frames_saved"] += len(buffer) - 1
+        sse_stats["bytes_saved"] += (len(buffer) - 1) * SSE_FRAME_OVERHEAD
+        event = {'output': "".join(buffer)}
+        buffer.clear()
+        return event
+
+    buffer = []
+    buffered_bytes = 0
+    flush_at = None
+    sent_text = False
+    task = asyncio.create_task(pump())
+    try:
+        while True:
+            if buffer:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=max(0.0, flush_at - time.monotonic()))
+                except asyncio.TimeoutError:
+                    yield flush()
+                    continue
+            else:
+                event = await queue.get()
+            if event is None:
+                break
+            if len(event) == 1 and event.get('output'):
+                if not buffer:
+                    flush_at = time.monotonic() + window
+                    buffered_bytes = 0
+                buffer.append(event['output'])
+                buffered_bytes += len(event['output'])
+                if not sent_text or buffered_bytes >= max_bytes or time.monotonic() >= flush_at:
+                    sent_text = True
+                    yield flush()
+                continue
+            if buffer:
+                yield flush()
+            sse_stats["events_in"] += 1
+            sse_stats["frames_out"] += 1
+            yield event
+        if buffer:
+            yield flush()
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+# Forecast result cache
+# The prompt is a pure function of (text, horizon, severity), so identical requests
+# against the same provider/model can be replayed from memory. Entries expire after
+# FORECAST_CACHE_TTL seconds and the least recently used ones are evicted once the
+# cached responses exceed FORECAST_CACHE_MAX_BYTES.
+class ForecastCache:
+    def __init__(self):
+        self.ttl = float(get_env_var("FORECAST_CACHE_TTL", "3600"))
+        self.max_bytes = int(get_env_var("FORECAST_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    @staticmethod
+    def key(text: str, horizon: str, severity: str, provider: str, model: str) -> str:
+        normalized = " ".join(text.split()).casefold()
+        raw = json.dumps([normalized, horizon, severity, provider, model])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_bytes > 0
+
+    def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        expires_at, output = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return output
+
+    def __contains__(self, key: str) -> bool:
+        # Existence check without touching hit/miss stats or recency
+        entry = self._entries.get(key)
+        return entry is not None and entry[0] >= time.monotonic()
+
+    def put(self, key: str, output: str):
+        size = len(output.encode("utf-8"))
+        if not self.enabled or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, output)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        _, output = self._entries.pop(key)
+        self._bytes -= len(output.encode("utf-8"))
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+
+forecast_cache = ForecastCache()
+
+# Near-duplicate forecast index (MinHash + LSH)
+# Inputs are reduced to character shingles over lightly stemmed words (stopwords
+# dropped, plural and -ing/-ed endings stripped), signed with SIMILAR_NUM_PERM
+# MinHash permutations and bucketed into LSH bands. A new input whose estimated
+# Jaccard similarity to a stored one reaches SIMILAR_THRESHOLD, for the same
+# horizon, severity, negations and numbers, is answered with that stored forecast.
+# One "not" or a changed figure flips the scenario while barely moving the score,
+# so those words have to match exactly. The index is loaded from the
+# queries table at startup, grows as forecasts complete and evicts the least
+# recently used entries beyond SIMILAR_INDEX_MAX_BYTES.
+SIMILAR_STOPWORDS = frozenset("a an and are at be by for from in into is it its of on or our the to we with".split())
+SIMILAR_NEGATIONS = frozenset("not no never none nobody nothing neither nor without cannot".split())
+SIMILAR_SUFFIXES = ("ing", "ed", "s")
+_MERSENNE_61 = (1 << 61) - 1
+
+class SimilarForecastIndex:
+    SHINGLE_SIZE = 3
+    ENTRY_OVERHEAD = 1024
+    # Bounds the candidates per band when many stored inputs are alike
+    BUCKET_CAP = 32
+
+    def __init__(self):
+        self.threshold = float(get_env_var("SIMILAR_THRESHOLD", "0.95"))
+        self.num_perm = int(get_env_var("SIMILAR_NUM_PERM", "64"))
+        self.bands = int(get_env_var("SIMILAR_BANDS", "16"))
+        self.max_bytes = int(get_env_var("SIMILAR_INDEX_MAX_BYTES", str(16 * 1024 * 1024)))
+        self.load_limit = int(get_env_var("SIMILAR_INDEX_LOAD_LIMIT", "5000"))
+        # Longer inputs are signed on a worker thread (about 10 ms of CPU at this size)
+        self.inline_chars = int(get_env_var("SIMILAR_SIGN_INLINE_CHARS", "1000"))
+        self.rows = max(1, self.num_perm // max(1, self.bands))
+        rng = random.Random(20240601)
+        self._perms = [(rng.randrange(1, _MERSENNE_61), rng.randrange(0, _MERSENNE_61)) for _ in range(self.num_perm)]
+        self._entries = OrderedDict()
+        self._buckets = {}
+        self._exact = {}
+        self._next_id = 0
+        self._bytes = 0
+        self._load_task = None
+        self.stats = {"hits": 0, "misses": 0, "added": 0, "evictions": 0, "loaded": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return 0 < self.threshold <= 1 and self.max_bytes > 0 and self.num_perm > 0
+
+    @staticmethod
+    def stem(word: str) -> str:
+        if word in SIMILAR_NEGATIONS or any(c.isdigit() for c in word):
+            return word
+        for suffix in SIMILAR_SUFFIXES:
+            if word.endswith(suffix) and not word.endswith("ss") and len(word) - len(suffix) >= 3:
+                return word[:-len(suffix)]
+        return word
+
+    def words(self, text: str) -> list:
+        words = re.findall(r"\w+", text.casefold().replace("n't", " not"))
+        words = [w for w in words if w not in SIMILAR_STOPWORDS] or words
+        return [self.stem(w) for w in words]
+
+    def normalize(self, text: str) -> str:
+        return " ".join(self.words(text))
+
+    def shingles(self, text: str) -> set:
+        joined = self.normalize(text)
+        size = self.SHINGLE_SIZE
+        return {joined[i:i + size] for i in range(max(1, len(joined) - size + 1))}
+
+    def signature(self, text: str) -> array:
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+            for shingle in self.shingles(text)
+        ]
+        return array("Q", [min((a * h + b) % _MERSENNE_61 for h in hashes) for a, b in self._perms])
+
+    def scope(self, text: str, horizon: str, severity: str) -> tuple:
+        """Only inputs in the same scope are compared: horizon, severity, negations and numbers."""
+        guards = frozenset(w for w in self.words(text) if w in SIMILAR_NEGATIONS or any(c.isdigit() for c in w))
+        return (horizon if horizon in HORIZON_MAP else "mid", severity, guards)
+
+    def _band_keys(self, scope: tuple, signature: array) -> list:
+        rows = self.rows
+        return [hash((scope, band, tuple(signature[band * rows:(band + 1) * rows]))) for band in range(self.bands)]
+
+    def _best(self, scope: tuple, signature: array):
+        candidates = set()
+        for key in self._band_keys(scope, signature):
+            candidates.update(self._buckets.get(key, ()))
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            entry = self._entries[entry_id]
+            if entry[0] != scope:
+                continue
+            score = sum(1 for x, y in zip(signature, entry[1]) if x == y) / self.num_perm
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        return best_id, best_score
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def sign(self, text: str) -> array:
+        """signature(), kept off the event loop for long inputs."""
+        if len(text) > self.inline_chars:
+            return await asyncio.to_thread(self.signature, text)
+        return self.signature(text)
+
+    def lookup(self, text: str, horizon: str, severity: str, signature: array = None):
+        """(stored forecast, estimated similarity) of the closest input above the threshold, or None."""
+        if not self.enabled or not self._entries:
+            return None
+        signature = signature if signature is not None else self.signature(text)
+        entry_id, score = self._best(self.scope(text, horizon, severity), signature)
+        if entry_id is None or score < self.threshold:
+            return None
+        self._entries.move_to_end(entry_id)
+        return self._entries[entry_id][2], score
+
+    def add(self, text: str, horizon: str, severity: str, output: str, signature: array = None):
+        if not self.enabled or not output:
+            return
+        scope = self.scope(text, horizon, severity)
+        signature = signature if signature is not None else self.signature(text)
+        exact_key = (scope, self.normalize(text))
+        if exact_key in self._exact:
+            # Same input after normalization: keep the newer forecast
+            self._remove(self._exact[exact_key])
+        size = len(output.encode("utf-8")) + len(text.encode("utf-8")) + signature.itemsize * len(signature) + self.ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (scope, signature, output, size, exact_key)
+        self._exact[exact_key] = entry_id
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.setdefault(key, [])
+            bucket.append(entry_id)
+            if len(bucket) > self.BUCKET_CAP:
+                del bucket[0]
+        self._bytes += size
+        self.stats["added"] += 1
+        while self._bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.stats["evictions"] += 1
+
+    def _remove(self, entry_id: int):
+        scope, signature, _, size, exact_key = self._entries.pop(entry_id)
+        del self._exact[exact_key]
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket is None or entry_id not in bucket:
+                continue
+            bucket.remove(entry_id)
+            if not bucket:
+                del self._buckets[key]
+        self._bytes -= size
+
+    async def load(self):
+        """Seed the index with the newest stored forecasts."""
+        try:
+            async with get_db_connection() as conn:
+                if not conn:
+                    return
+                rows = await conn.fetch(SIMILAR_LOAD_SQL, self.load_limit)
+            rows = list(reversed(rows))
+            # Signing a few thousand inputs is CPU work; keep it off the event loop
+            signatures = await asyncio.to_thread(lambda: [self.signature(row["user_text"]) for row in rows])
+            for row, signature in zip(rows, signatures):
+                self.add(row["user_text"], row["horizon"] or "mid", row["severity"] or "realistic", row["response_text"], signature)
+            self.stats["loaded"] += len(rows)
+            print(f"Similar forecast index loaded {len(rows)} forecasts")
+        except Exception as e:
+            print(f"Similar forecast index load error: {e}")
+
+    def start_loading(self):
+        if self.enabled and self.load_limit > 0 and self._load_task is None:
+            self._load_task = asyncio.create_task(self.load())
+
+    async def close(self):
+        if self._load_task is not None:
+            self._load_task.cancel()
+            await asyncio.gather(self._load_task, return_exceptions=True)
+            self._load_task = None
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, entries=len(self._entries), bytes=self._bytes)
+
+similar_index = SimilarForecastIndex()
+
+# Single-flight coalescing of identical in-flight predictions
+# The first request for a cache key starts the upstream generation; identical
+# requests arriving while it runs subscribe to the same broadcast buffer, replay
+# the chunks produced so far and then follow it live. The upstream stream is
+# cancelled once every subscriber has gone away (after `linger` seconds, if set,
+# so that a reconnecting subscriber can still pick it up).
+class Broadcast:
+    def __init__(self, key: str, source: AsyncGenerator[dict, None], linger: float = 0.0):
+        self.key = key
+        self.events = []
+        self.done = False
+        self.finished_at = None
+        self.abandoned = False
+        self.subscribers = 0
+        self.linger = linger
+        self._source = source
+        self._changed = asyncio.Event()
+        self._abandon_handle = None
+        self._task = asyncio.create_task(self._pump())
+        self._task.add_done_callback(self._finish)
+
+    async def _pump(self):
+        try:
+            async for event in self._source:
+                self.events.append(event)
+                self._notify()
+        finally:
+            await self._source.aclose()
+
+    def _finish(self, task):
+        self.done = True
+        self.finished_at = time.monotonic()
+        self._notify()
+        if inflight_predictions.get(self.key) is self:
+            del inflight_predictions[self.key]
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, position: int = 0) -> AsyncGenerator[dict, None]:
+        self.subscribers += 1
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+        try:
+            while True:
+                while position < len(self.events):
+                    yield self.events[position]
+                    position += 1
+                if self.done:
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                if self.linger > 0:
+                    self._abandon_handle = asyncio.get_running_loop().call_later(self.linger, self._abandon)
+                else:
+                    self._abandon()
+
+    def _abandon(self):
+        self._abandon_handle = None
+        if self.subscribers == 0 and not self.done:
+            self.cancel()
+
+    def cancel(self):
+        """Stop the source now, whoever is still subscribed."""
+        if self._abandon_handle is not None:
+            self._abandon_handle.cancel()
+            self._abandon_handle = None
+        if not self.done:
+            self.abandoned = True
+            self._task.cancel()
+
+inflight_predictions = {}
+_inflight_stats = {"started": 0, "joined": 0}
+
+def join_or_start(key: str, start) -> Broadcast:
+    flight = inflight_predictions.get(key)
+    if flight is not None and not flight.done:
+        _inflight_stats["joined"] += 1
+        return flight
+    flight = Broadcast(key, start())
+    inflight_predictions[key] = flight
+    _inflight_stats["started"] += 1
+    return flight
+
+# Resumable prediction streams
+# Each /api/predict response is one generation with a random ID, and every SSE
+# frame carries `id: <generation>:<seq>`. The frames live in the generation's
+# Broadcast buffer; the last STREAM_JOURNAL_SIZE generations stay reachable until
+# STREAM_JOURNAL_TTL seconds after they finish. A client that reconnects with a
+# Last-Event-ID gets the frames it missed and then follows the generation live,
+# without another provider call. When the client goes away the generation is
+# cancelled at once, unless the request was sent with "resumable": true; then
+# it keeps running for STREAM_RESUME_GRACE seconds waiting for the reconnect.
+# A client that is leaving for good ends it right away with /api/predict/cancel.
+class StreamJournal:
+    def __init__(self):
+        self.max_streams = int(get_env_var("STREAM_JOURNAL_SIZE", "1000"))
+        self.ttl = float(get_env_var("STREAM_JOURNAL_TTL", "120"))
+        self.grace = float(get_env_var("STREAM_RESUME_GRACE", "2"))
+        self._streams = OrderedDict()
+        self.stats = {"generations": 0, "resumed": 0, "resume_misses": 0, "cancelled": 0}
+
+    def start(self, source: AsyncGenerator[dict, None], resumable: bool = False):
+        generation = secrets.token_urlsafe(12)
+        flight = Broadcast(generation, source, linger=self.grace if resumable else 0.0)
+        self._expire()
+        self._streams[generation] = flight
+        while len(self._streams) > self.max_streams:
+            self._streams.popitem(last=False)
+        self.stats["generations"] += 1
+        return generation, flight
+
+    def resume(self, last_event_id: str):
+        """(generation, broadcast, position to continue from) for a Last-Event-ID, or None."""
+        generation, _, seq = last_event_id.strip().partition(":")
+        self._expire()
+        flight = self._streams.get(generation)
+        # An abandoned generation was cut short: resuming it would end mid-answer
+        if flight is None or flight.abandoned or not seq.isdigit() or int(seq) > len(flight.events):
+            self.stats["resume_misses"] += 1
+            return None
+        self.stats["resumed"] += 1
+        return generation, flight, int(seq)
+
+    def cancel(self, generation: str) -> bool:
+        flight = self._streams.get(generation)
+        if flight is None or flight.done:
+            return False
+        flight.cancel()
+        self.stats["cancelled"] += 1
+        return True
+
+    def _expire(self):
+        # Oldest first; a generation still running stops the sweep
+        now = time.monotonic()
+        while self._streams:
+            flight = next(iter(self._streams.values()))
+            if flight.finished_at is None or flight.finished_at + self.ttl > now:
+                break
+            self._streams.popitem(last=False)
+
+    def snapshot(self) -> dict:
+        return dict(self.stats, streams=len(self._streams))
+
+stream_journal = StreamJournal()
+
+async def journal_frames(generation: str, flight: Broadcast, position: int = 0) -> AsyncGenerator[str, None]:
+    metrics.inc("wcgr_requests_in_flight")
+    try:
+        async for event in flight.subscribe(position):
+            position += 1
+            yield sse_event(event, f"{generation}:{position}")
+    finally:
+        metrics.inc("wcgr_requests_in_flight", -1)
+
+# Hedged requests
+# With hedging on, a second request goes to a backup provider if the primary has
+# not produced text within HEDGE_DEADLINE_MS (or failed before producing any).
+# Whichever stream yields text first wins and the other one is cancelled.
+def hedge_backup_provider(primary: str):
+    backup = get_env_var("HEDGE_PROVIDER").lower()
+    if backup in PROVIDER_STREAMS and backup != primary and provider_health[backup].available():
+        return backup
+    for name in provider_route(primary)[1:]:
+        if provider_health[name].available():
+            return name
+    return None
+
+async def hedged_stream(primary: str, backup: str, prompt: str, config: dict) -> AsyncGenerator[dict, None]:
+    deadline = time.monotonic() + float(get_env_var("HEDGE_DEADLINE_MS", "1500")) / 1000
+    queue = asyncio.Queue()
+
+    async def run(name: str):
+        try:
+            # The primary was claimed by the caller; the backup only once it is needed
+            if name == backup and not provider_health[name].admit():
+                queue.put_nowait((name, {'error': f"{name} is unavailable (circuit open)"}))
+                return
+            async for event in provider_stream(name, prompt, config):
+                queue.put_nowait((name, event))
+        finally:
+            queue.put_nowait((name, None))
+
+    tasks = {primary: asyncio.create_task(run(primary))}
+    running = {primary}
+    winner = None
+    last_error = None
+    try:
+        while winner is None:
+            timeout = None
+            if backup not in tasks:
+                timeout = max(0.0, deadline - time.monotonic())
+            try:
+                name, event = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                tasks[backup] = asyncio.create_task(run(backup))
+                running.add(backup)
+                continue
+            if event is None or 'error' in event:
+                if event is not None:
+                    last_error = event
+                    tasks[name].cancel()
+                running.discard(name)
+                if not running:
+                    if backup in tasks:
+                        yield last_error or {'error': 'No provider produced any output'}
+                        return
+                    # Primary failed before the deadline: hedge right away
+                    tasks[backup] = asyncio.create_task(run(backup))
+                    running.add(backup)
+                continue
+            if event.get('output'):
+                winner = name
+                for other, task in tasks.items():
+                    if other != winner:
+                        task.cancel("hedge_lost")
+                yield {'hedged': backup in tasks, 'winner': winner}
+                yield event
+
+        while True:
+            name, event = await queue.get()
+            if name != winner:
+                continue
+            if event is None:
+                return
+            yield event
+    finally:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
 
 @app.get("/api/ping")
 async def ping():
@@ -259,46 +2513,42 @@ async def ping():
     model = "unknown"
     has_key = False
 
-    if provider == "gemini":
-        model = get_env_var("GEMINI_MODEL", "gemini-2.0-flash")
-        has_key = bool(get_env_var("GEMINI_API_KEY"))
-    elif provider == "openai":
-        model = get_env_var("OPENAI_MODEL", "llama-3.3-70b-versatile")
-        has_key = bool(get_env_var("OPENAI_API_KEY")) or bool(get_env_var("OPENAI_BASE_URL"))
-    elif provider == "anthropic":
-        model = get_env_var("ANTHROPIC_MODEL", "claude-3-5-sonnet")
-        has_key = bool(get_env_var("ANTHROPIC_API_KEY"))
-    elif provider == "groq":
-        model = get_env_var("GROQ_MODEL", "llama-3.3-70b-versatile")
-        has_key = bool(get_env_var("GROQ_API_KEY"))
-
-    return {"ok": True, "hasKey": has_key, "model": f"{provider}/{model}"}
+    if provider in PROVIDER_STREAMS:
+        model = provider_model(provider)
+        has_key = provider_has_key(provider)
 
-@app.post("/api/predict")
-async def predict(request: Request):
-    try:
-        body = await request.json()
-    except:
-        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
-        
-    text = (body.get("text") or "").strip()
-    horizon = (body.get("horizon") or "mid").strip()
-    severity = (body.get("severity") or "realistic").strip()
-
-    if not text:
-        return JSONResponse(status_code=400, content={"error": "Missing 'text'"})
+    providers = {}
+    for name in PROVIDER_STREAMS:
+        providers[name] = dict(provider_health[name].snapshot(), hasKey=provider_has_key(name), slots=provider_limits[name].snapshot())
 
-    provider = get_env_var("LLM_PROVIDER", "gemini").lower()
-    
-    horizon_map = {
-        "near": "near-term (hours to days)",
-        "mid": "mid-term (weeks to months)",
-        "far": "far-term (years)",
+    return {
+        "ok": True,
+        "hasKey": has_key,
+        "providers": providers,
+        "model": f"{provider}/{model}",
+        "db": db_pool_stats(),
+        "ingest": query_log_writer.snapshot(),
+        "cache": forecast_cache.snapshot(),
+        "similar": similar_index.snapshot(),
+        "inflight": dict(_inflight_stats, active=len(inflight_predictions)),
+        "sse": sse_stats,
+        "rateLimit": rate_limiter.snapshot(),
+        "coldStart": cold_start,
+        "sharedState": shared_state.snapshot() if shared_state is not None else None,
+        "streamJournal": stream_journal.snapshot(),
     }
-    horizon_desc = horizon_map.get(horizon, horizon_map["mid"])
+
+HORIZON_MAP = {
+    "near": "near-term (hours to days)",
+    "mid": "mid-term (weeks to months)",
+    "far": "far-term (years)",
+}
+
+def build_prompt(text: str, horizon: str, severity: str) -> str:
+    horizon_desc = HORIZON_MAP.get(horizon, HORIZON_MAP["mid"])
     tone = "realistic and plausible" if severity == "realistic" else "aggressive worst-case but still plausible"
 
-    prompt = f"""You are an adversarial-but-helpful risk forecaster.
+    return f"""You are an adversarial-but-helpful risk forecaster.
 Task: Given the user's input, describe the WORST PLAUSIBLE chain of events it could cause.
 
 Rules:
@@ -315,91 +2565,574 @@ Rules:
 User input:
 {text}
 """
-    config = {"temperature": 0.9 if severity != "realistic" else 0.7}
 
-    async def stream_logic():
+def default_provider():
+    configured = get_env_var("LLM_PROVIDER", "gemini").lower()
+    return select_provider(configured if configured in PROVIDER_STREAMS else "gemini")
+
+def forecast_key(text: str, horizon: str, severity: str, provider: str) -> str:
+    cache_horizon = horizon if horizon in HORIZON_MAP else "mid"
+    return forecast_cache.key(text, cache_horizon, severity, provider, provider_model(provider))
+
+async def forecast_needs_upstream(text: str, horizon: str, severity: str, provider: str, backup=None) -> bool:
+    """False when the forecast can be served from the cache or an identical in-flight generation."""
+    cache_key = forecast_key(text, horizon, severity, provider)
+    if forecast_cache.enabled and cache_key in forecast_cache:
+        return False
+    if similar_index.enabled and len(similar_index) and similar_index.lookup(text, horizon, severity, await similar_index.sign(text)) is not None:
+        return False
+    flight = inflight_predictions.get(cache_key + (":hedged" if backup else ""))
+    return flight is None or flight.done
+
+async def forecast_stream(text: str, horizon: str, severity: str, provider: str, backup=None) -> AsyncGenerator[dict, None]:
+    """Forecast events for one input: served from the cache, an identical in-flight
+    generation, or a new upstream (optionally hedged) stream."""
+    prompt = build_prompt(text, horizon, severity)
+    config = {"temperature": 0.9 if severity != "realistic" else 0.7, "deadline": Deadline()}
+
+    cache_key = forecast_key(text, horizon, severity, provider)
+    cached = forecast_cache.get(cache_key) if forecast_cache.enabled else None
+    if cached is None and forecast_cache.enabled and shared_state is not None:
+        shared = await shared_state.get(f"forecast:{cache_key}")
+        if shared is not None:
+            cached = shared.decode("utf-8")
+            forecast_cache.put(cache_key, cached)
+    if cached is not None:
+        yield {'output': cached, 'cached': True}
+        return
+    signature = None
+    if similar_index.enabled:
+        # Seeds the index in the background on first use (already running unless FAST_START)
+        similar_index.start_loading()
+        signature = await similar_index.sign(text)
+        match = similar_index.lookup(text, horizon, severity, signature)
+        if match is not None:
+            similar_index.stats["hits"] += 1
+            yield {'output': match[0], 'cached': True, 'similarity': round(match[1], 3)}
+            return
+        similar_index.stats["misses"] += 1
+
+    async def generate():
+        parts = []
+        failed = False
+        # Cache hits and joins never get here, so only a real upstream request claims a probe
+        served_by = claim_provider(provider)
+        if served_by is None:
+            yield {'error': "All providers are unavailable (circuit open)"}
+            return
+        if served_by != provider:
+            yield {'winner': served_by}
+        if backup and backup != served_by:
+            events = hedged_stream(served_by, backup, prompt, config)
+        else:
+            events = provider_stream(served_by, prompt, config)
+        async for event in events:
+            if 'error' in event:
+                failed = True
+            elif 'winner' in event:
+                served_by = event['winner']
+            elif event.get('output'):
+                parts.append(event['output'])
+            yield event
+        if parts and not failed:
+            output = "".join(parts)
+            served_key = forecast_key(text, horizon, severity, served_by)
+            forecast_cache.put(served_key, output)
+            if forecast_cache.enabled and shared_state is not None:
+                await shared_state.set(f"forecast:{served_key}", output.encode("utf-8"), forecast_cache.ttl)
+            similar_index.add(text, horizon, severity, output, signature)
+
+    flight = join_or_start(cache_key + (":hedged" if backup else ""), generate)
+    async for event in flight.subscribe():
+        yield event
+
+# Server-side persistence of served forecasts
+# predict() tees the events it streams into a ForecastRecord and hands the full
+# response to the write-behind queue once the stream ends, so the browser no
+# longer posts it back through /api/log_query. token_count is the number of
+# upstream text deltas (None when the answer came from the cache).
+class ForecastRecord:
+    def __init__(self, text: str, horizon: str, severity: str, provider: str, ip_address: str):
+        self.text = text
+        self.horizon = horizon
+        self.severity = severity
+        self.provider = provider
+        self.ip_address = ip_address
+        self.started = time.monotonic()
+        self.parts = []
+        self.deltas = 0
+        self.cached = False
+        self.failed = False
+
+    def observe(self, event: dict):
+        if 'error' in event:
+            self.failed = True
+        elif 'winner' in event:
+            self.provider = event['winner']
+        elif event.get('output'):
+            self.parts.append(event['output'])
+            self.deltas += 1
+            self.cached = self.cached or bool(event.get('cached'))
+
+    async def tee(self, events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+        async for event in events:
+            self.observe(event)
+            yield event
+
+    @property
+    def persistable(self) -> bool:
+        return bool(self.parts) and not self.failed
+
+    def row(self) -> tuple:
+        response = "".join(self.parts)
+        return (
+            self.text, self.horizon, self.severity, f"{self.provider}/{provider_model(self.provider)}",
+            response[:200], self.ip_address, datetime.now(timezone.utc),
+            response, self.provider, None if self.cached else self.deltas,
+            int((time.monotonic() - self.started) * 1000),
+        )
+
+def persist_forecast(record: ForecastRecord) -> bool:
+    """Queue a finished (or client-abandoned) forecast without blocking the stream."""
+    if not record.persistable or not get_env_var("POSTGRES_URL"):
+        return False
+    history_cache.invalidate(record.ip_address)
+    return query_log_writer.enqueue(record.row())
+
+async def recorded_generation(record: ForecastRecord, events: AsyncGenerator[dict, None]) -> AsyncGenerator[dict, None]:
+    """The coalesced events of one generation. It is persisted once when it ends,
+    however many connections (resumes) followed it."""
+    try:
+        async for event in coalesce_events(record.tee(events)):
+            yield event
+    finally:
+        # Also reached when the generation is abandoned: keep what was produced
+        if not LOG_WRITE_BEHIND:
+            if record.persistable and get_env_var("POSTGRES_URL"):
+                history_cache.invalidate(record.ip_address)
+                # Shielded: an abandoned generation is being cancelled right now
+                await asyncio.shield(query_log_writer.write([record.row()]))
+        else:
+            persist_forecast(record)
+
+@app.get("/api/metrics")
+async def metrics_endpoint():
+    # Point-in-time values from the stats the other components already keep
+    snapshot = {}
+    for name, value in db_pool_stats().items():
+        snapshot[(f"wcgr_db_pool_{name}", ())] = value
+    for name, value in query_log_writer.snapshot().items():
+        snapshot[(f"wcgr_ingest_{name}", ())] = value
+    for name, value in forecast_cache.snapshot().items():
+        snapshot[(f"wcgr_forecast_cache_{name}", ())] = value
+    for name, value in similar_index.snapshot().items():
+        snapshot[(f"wcgr_similar_index_{name}", ())] = value
+    if shared_state is not None:
+        for name, value in shared_state.stats.items():
+            snapshot[(f"wcgr_shared_state_{name}", ())] = value
+    for name, value in stream_journal.snapshot().items():
+        snapshot[(f"wcgr_stream_journal_{name}", ())] = value
+    for name in ("import_seconds", "first_request_seconds", "first_response_after_import_seconds"):
+        if cold_start[name] is not None:
+            snapshot[(f"wcgr_cold_start_{name}", ())] = cold_start[name]
+    for name, value in sse_stats.items():
+        snapshot[(f"wcgr_sse_{name}", ())] = value
+    for name, health in provider_health.items():
+        snapshot[("wcgr_provider_breaker_open", (("provider", name),))] = int(health.snapshot()["state"] == "open")
+        snapshot[("wcgr_provider_error_rate", (("provider", name),))] = health.error_rate
+    for name, limiter in provider_limits.items():
+        snapshot[("wcgr_provider_streams_active", (("provider", name),))] = limiter.active
+        snapshot[("wcgr_provider_streams_waiting", (("provider", name),))] = limiter.waiting
+    return Response(content=metrics.render(snapshot), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post("/api/predict")
+async def predict(request: Request):
+    last_event_id = request.headers.get("last-event-id")
+    if last_event_id:
+        # Reconnect: replay from the journal, no rate limit or provider slot needed.
+        # Unknown or expired generations fall through to a new one.
+        resumed = stream_journal.resume(last_event_id)
+        if resumed is not None:
+            return StreamingResponse(journal_frames(*resumed), media_type="text/event-stream")
+
+    try:
+        body = await request.json()
+    except:
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
+        
+    text = (body.get("text") or "").strip()
+    horizon = (body.get("horizon") or "mid").strip()
+    severity = (body.get("severity") or "realistic").strip()
+
+    if not text:
+        return JSONResponse(status_code=400, content={"error": "Missing 'text'"})
+
+    ip_address = client_ip(request)
+    wait = await rate_limiter.acquire(ip_address)
+    if wait:
+        metrics.inc("wcgr_rejected_total", reason="rate_limit")
+        return too_many_requests("Rate limit exceeded", wait)
+
+    provider = default_provider()
+    if provider is None:
+        return JSONResponse(status_code=503, content={"error": "All providers are unavailable (circuit open)"})
+
+    hedge = body.get("hedge")
+    if hedge is None:
+        hedge = get_env_var("HEDGE_ENABLED") == "1"
+    backup = hedge_backup_provider(provider) if hedge else None
+
+    # Cache hits and joins never take an upstream slot, so only new generations are turned away
+    limiter = provider_limits[provider]
+    if limiter.saturated() and await forecast_needs_upstream(text, horizon, severity, provider, backup):
+        metrics.inc("wcgr_rejected_total", reason="provider_queue", provider=provider)
+        return too_many_requests(f"{provider} is at capacity, try again shortly", limiter.retry_after())
+    record = ForecastRecord(text, horizon, severity, provider, ip_address)
+    generation, flight = stream_journal.start(
+        recorded_generation(record, forecast_stream(text, horizon, severity, provider, backup)),
+        resumable=bool(body.get("resumable")),
+    )
+    return StreamingResponse(journal_frames(generation, flight), media_type="text/event-stream")
+
+# Sent by the frontend (navigator.sendBeacon) when the user aborts or leaves the
+# page, so the generation stops without waiting out STREAM_RESUME_GRACE. The
+# generation ID is random and only known to the client that started it.
+@app.post("/api/predict/cancel")
+async def predict_cancel(request: Request):
+    try:
+        body = await request.json()
+    except:
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
+    generation = body.get("generation") if isinstance(body, dict) else None
+    if not isinstance(generation, str) or not generation:
+        return JSONResponse(status_code=400, content={"error": "Missing 'generation'"})
+    return {"cancelled": stream_journal.cancel(generation.partition(":")[0])}
+
+# Batch forecasting
+# Items run concurrently, at most BATCH_MAX_CONCURRENCY per provider, and their
+# events are multiplexed onto one NDJSON (default) or SSE response, each tagged
+# with the item's index. A failing item only produces an error event for itself.
+@app.post("/api/predict/batch")
+async def predict_batch(request: Request):
+    try:
+        body = await request.json()
+    except:
+        return JSONResponse(status_code=400, content={"error": "Invalid JSON"})
+
+    items = body.get("items") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not items:
+        return JSONResponse(status_code=400, content={"error": "Missing 'items'"})
+    max_items = int(get_env_var("BATCH_MAX_ITEMS", "500"))
+    if len(items) > max_items:
+        return JSONResponse(status_code=400, content={"error": f"At most {max_items} items per batch"})
+
+    max_concurrency = int(get_env_var("BATCH_MAX_CONCURRENCY", "4"))
+    try:
+        concurrency = max(1, min(int(body.get("concurrency") or max_concurrency), max_concurrency))
+    except (TypeError, ValueError):
+        return JSONResponse(status_code=400, content={"error": "Invalid 'concurrency'"})
+    as_sse = body.get("format") == "sse"
+    ip_address = client_ip(request)
+    # A batch costs one token per item; one larger than the bucket could never be admitted
+    if rate_limiter.enabled and len(items) > rate_limiter.burst:
+        metrics.inc("wcgr_rejected_total", reason="rate_limit")
+        return JSONResponse(status_code=413, content={"error": f"At most {int(rate_limiter.burst)} items per batch under the rate limit"})
+    wait = await rate_limiter.acquire(ip_address, cost=len(items))
+    if wait:
+        metrics.inc("wcgr_rejected_total", reason="rate_limit")
+        return too_many_requests("Rate limit exceeded", wait)
+
+    limits = {}
+    queue = asyncio.Queue()
+    rows = []
+
+    async def run_item(index: int, item):
         try:
-            if provider == "openai":
-                async for chunk in _openai_stream(prompt, config):
-                    yield chunk
-            elif provider == "anthropic":
-                async for chunk in _anthropic_stream(prompt, config):
-                    yield chunk
-            elif provider == "groq":
-                async for chunk in _groq_stream(prompt, config):
-                    yield chunk
-            else:
-                async for chunk in _gemini_stream(prompt, config):
-                    yield chunk
+            if not isinstance(item, dict):
+                queue.put_nowait({'index': index, 'error': "Invalid item"})
+                return
+            for field in ("text", "horizon", "severity"):
+                if item.get(field) is not None and not isinstance(item[field], str):
+                    queue.put_nowait({'index': index, 'error': f"Invalid '{field}'"})
+                    return
+            text = (item.get("text") or "").strip()
+            horizon = (item.get("horizon") or "mid").strip()
+            severity = (item.get("severity") or "realistic").strip()
+            if not text:
+                queue.put_nowait({'index': index, 'error': "Missing 'text'"})
+                return
+            provider = default_provider()
+            if provider is None:
+                queue.put_nowait({'index': index, 'error': "All providers are unavailable (circuit open)"})
+                return
+
+            record = ForecastRecord(text, horizon, severity, provider, ip_address)
+            limit = limits.setdefault(provider, asyncio.Semaphore(concurrency))
+            async with limit:
+                async for event in coalesce_events(record.tee(forecast_stream(text, horizon, severity, provider))):
+                    queue.put_nowait(dict(event, index=index))
+            if record.persistable:
+                rows.append(record.row())
         except Exception as e:
-            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+            queue.put_nowait({'index': index, 'error': str(e)})
+        finally:
+            queue.put_nowait({'index': index, 'done': True})
+
+    def frame(event: dict) -> str:
+        return sse_event(event) if as_sse else dumps(event) + "\n"
+
+    async def stream_logic():
+        tasks = [asyncio.create_task(run_item(index, item)) for index, item in enumerate(items)]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await queue.get()
+                if event.get('done'):
+                    remaining -= 1
+                yield frame(event)
+            yield frame({'done': True, 'completed': len(rows), 'failed': len(items) - len(rows)})
+        finally:
+            for task in tasks:
+                task.cancel()
+            # Items that finished are kept even when the client gave up mid-batch
+            if rows and get_env_var("POSTGRES_URL"):
+                history_cache.invalidate(ip_address)
+                if LOG_WRITE_BEHIND:
+                    for row in rows:
+                        query_log_writer.enqueue(row)
+                else:
+                    # One bulk insert, shielded from the cancellation of an abandoned response
+                    await asyncio.shield(query_log_writer.write(rows))
 
-    return StreamingResponse(stream_logic(), media_type="text/event-stream")
+    media_type = "text/event-stream" if as_sse else "application/x-ndjson"
+    return StreamingResponse(stream_logic(), media_type=media_type)
 
-# Log query in background (called after predict)
+# Kept for older frontends that still post here after a prediction; /api/predict
+# now persists the full forecast itself, so recording it again would duplicate it.
 @app.post("/api/log_query")
 async def log_query(request: Request):
-    try:
-        body = await request.json()
-        text = body.get("text", "")
-        horizon = body.get("horizon", "")
-        severity = body.get("severity", "")
-        model_used = body.get("model_used", "unknown")
-        response_preview = body.get("response_preview", "")[:200]
-        
-        # Get IP address
-        # Vercel and other proxies usually put the client IP first in x-forwarded-for
-        forwarded_for = request.headers.get("x-forwarded-for")
-        if forwarded_for:
-            # Handle list like "103.21.244.0, 10.0.0.1" -> take the first one
-            ip_address = forwarded_for.split(",")[0].strip()
-        else:
-            # Fallback to direct client host
-            ip_address = request.client.host if request.client else "unknown"
-
-        with get_db_connection() as conn:
-            if conn:
-                cursor = conn.cursor()
-                cursor.execute(
-                    "INSERT INTO queries (user_text, horizon, severity, model_used, response_preview, ip_address) VALUES (%s, %s, %s, %s, %s, %s)",
-                    (text, horizon, severity, model_used, response_preview, ip_address)
-                )
-                conn.commit()
-                cursor.close()
-        return JSONResponse(content={"status": "logged"})
-    except Exception as e:
-        print(f"Logging error: {e}")
-        return JSONResponse(content={"error": str(e)}, status_code=500)
+    return JSONResponse(content={"status": "logged"})
+
+# Short-lived per-IP history cache
+# The frontend refetches history after every prediction; pages are kept for
+# HISTORY_CACHE_TTL seconds and dropped as soon as that IP logs a new query.
+# Each IP keeps its HISTORY_CACHE_MAX_PAGES most recently used pages, and the
+# HISTORY_CACHE_MAX_IPS most recently active IPs are kept.
+class HistoryCache:
+    # Generations only have to outlive the pages they guard
+    GENERATION_TTL = 3600
+
+    def __init__(self):
+        self.ttl = float(get_env_var("HISTORY_CACHE_TTL", "10"))
+        self.max_ips = int(get_env_var("HISTORY_CACHE_MAX_IPS", "10000"))
+        self.max_pages = int(get_env_var("HISTORY_CACHE_MAX_PAGES", "20"))
+        self._pages = OrderedDict()
+
+    def get(self, ip_address: str, page_key: tuple):
+        pages = self._pages.get(ip_address)
+        if not pages or page_key not in pages:
+            return None
+        expires_at, payload = pages[page_key]
+        if expires_at < time.monotonic():
+            del pages[page_key]
+            return None
+        pages.move_to_end(page_key)
+        self._pages.move_to_end(ip_address)
+        return payload
+
+    def put(self, ip_address: str, page_key: tuple, payload: dict):
+        if self.ttl <= 0 or self.max_pages <= 0:
+            return
+        now = time.monotonic()
+        pages = self._pages.setdefault(ip_address, OrderedDict())
+        for key in [key for key, (expires_at, _) in pages.items() if expires_at < now]:
+            del pages[key]
+        pages[page_key] = (now + self.ttl, payload)
+        pages.move_to_end(page_key)
+        while len(pages) > self.max_pages:
+            pages.popitem(last=False)
+        self._pages.move_to_end(ip_address)
+        while len(self._pages) > self.max_ips:
+            self._pages.popitem(last=False)
+
+    def __len__(self) -> int:
+        return sum(len(pages) for pages in self._pages.values())
+
+    def invalidate(self, ip_address: str):
+        self._pages.pop(ip_address, None)
+        if shared_state is not None:
+            # Other workers see the new generation and stop serving their copies
+            spawn(shared_state.incr(f"history-gen:{ip_address}", 1, self.GENERATION_TTL))
+
+    async def generation(self, ip_address: str):
+        if shared_state is None or self.ttl <= 0:
+            return None
+        value = await shared_state.get(f"history-gen:{ip_address}")
+        return None if value is None else int(value)
+
+history_cache = HistoryCache()
+
+# Cursors are "<created_at>,<id>" with a UTC 'Z' timestamp so they stay URL-safe
+def format_history_cursor(created_at: datetime, row_id: int) -> str:
+    return f"{created_at.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')},{row_id}"
+
+def parse_history_cursor(cursor: str):
+    created_at, _, row_id = cursor.rpartition(",")
+    return datetime.fromisoformat(created_at.replace("Z", "+00:00")), int(row_id)
 
 # Endpoint to get query history
 @app.get("/api/history")
-async def get_history(request: Request, limit: int = 20):
+async def get_history(request: Request, limit: int = 20, before: str = ""):
     try:
-        # Get IP address
-        forwarded_for = request.headers.get("x-forwarded-for")
-        if forwarded_for:
-            ip_address = forwarded_for.split(",")[0].strip()
-        else:
-            ip_address = request.client.host if request.client else "unknown"
+        ip_address = client_ip(request)
 
-        with get_db_connection() as conn:
+        limit = max(1, min(limit, 100))
+        cursor = None
+        if before:
+            try:
+                cursor = parse_history_cursor(before)
+            except ValueError:
+                return JSONResponse(status_code=400, content={"error": "Invalid 'before' cursor"})
+
+        page_key = (limit, before, await history_cache.generation(ip_address))
+        cached = history_cache.get(ip_address, page_key)
+        if cached is not None:
+            return JSONResponse(content=cached)
+
+        async with get_db_connection() as conn:
             if not conn:
-                return JSONResponse(content={"queries": []})
+                return JSONResponse(content={"queries": [], "next_cursor": None})
             
-            cursor = conn.cursor(cursor_factory=RealDictCursor)
-            cursor.execute(
-                "SELECT id, user_text, horizon, severity, model_used, created_at FROM queries WHERE ip_address = %s ORDER BY created_at DESC LIMIT %s",
-                (ip_address, limit)
-            )
-            queries = cursor.fetchall()
-            cursor.close()
-            
-            # Convert datetime to ISO format
-            for q in queries:
-                if q['created_at']:
-                    q['created_at'] = q['created_at'].isoformat()
-            
-            return JSONResponse(content={"queries": queries})
+            with metrics.timer("wcgr_db_query_seconds", query="history"):
+                if cursor:
+                    rows = await conn.fetch(HISTORY_BEFORE_SQL, ip_address, cursor[0], cursor[1], limit)
+                else:
+                    rows = await conn.fetch(HISTORY_SQL, ip_address, limit)
+            queries = [dict(row) for row in rows]
+
+        next_cursor = None
+        if len(queries) == limit:
+            last = queries[-1]
+            next_cursor = format_history_cursor(last['created_at'], last['id'])
+
+        # Convert datetime to ISO format
+        for q in queries:
+            if q['created_at']:
+                q['created_at'] = q['created_at'].isoformat()
+
+        payload = {"queries": queries, "next_cursor": next_cursor}
+        history_cache.put(ip_address, page_key, payload)
+        return JSONResponse(content=payload)
     except Exception as e:
         print(f"History fetch error: {e}")
         return JSONResponse(content={"queries": [], "error": str(e)})
+
+# Search cursors are "<rank>,<id>"; repr() round-trips the float4 rank exactly
+def format_search_cursor(rank: float, row_id: int) -> str:
+    return f"{rank!r},{row_id}"
+
+def parse_search_cursor(cursor: str):
+    rank, _, row_id = cursor.rpartition(",")
+    return float(rank), int(row_id)
+
+# Full-text search over the caller's history. The planner picks between the
+# per-IP index (few rows for this IP) and the GIN index (rare terms), so neither
+# case degrades into a scan of the whole table.
+@app.get("/api/history/search")
+async def search_history(request: Request, q: str = "", limit: int = 20, after: str = ""):
+    q = q.strip()
+    if not q:
+        return JSONResponse(status_code=400, content={"error": "Missing 'q'"})
+    limit = max(1, min(limit, 100))
+    cursor = None
+    if after:
+        try:
+            cursor = parse_search_cursor(after)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"error": "Invalid 'after' cursor"})
+
+    try:
+        ip_address = client_ip(request)
+        async with get_db_connection() as conn:
+            if not conn:
+                return JSONResponse(content={"queries": [], "next_cursor": None})
+            with metrics.timer("wcgr_db_query_seconds", query="search"):
+                if cursor:
+                    rows = await conn.fetch(SEARCH_AFTER_SQL, ip_address, q, cursor[0], cursor[1], limit)
+                else:
+                    rows = await conn.fetch(SEARCH_SQL, ip_address, q, limit)
+            queries = [dict(row) for row in rows]
+
+        next_cursor = None
+        if len(queries) == limit:
+            last = queries[-1]
+            next_cursor = format_search_cursor(last['rank'], last['id'])
+
+        for query in queries:
+            if query['created_at']:
+                query['created_at'] = query['created_at'].isoformat()
+
+        return JSONResponse(content={"queries": queries, "next_cursor": next_cursor})
+    except Exception as e:
+        print(f"History search error: {e}")
+        return JSONResponse(content={"queries": [], "error": str(e)})
+
+# Usage statistics
+# Served entirely from the rollup tables, so the cost depends on the number of
+# hours/IPs in the window rather than on the number of logged queries. Set
+# STATS_TOKEN to require `Authorization: Bearer <token>`; top IPs are only
+# reported then, since knowing an IP is enough to read that user's history.
+@app.get("/api/stats")
+async def get_stats(request: Request, days: int = 30, top: int = 10):
+    token = get_env_var("STATS_TOKEN")
+    if token and not hmac.compare_digest(request.headers.get("authorization", ""), f"Bearer {token}"):
+        return JSONResponse(status_code=401, content={"error": "Unauthorized"})
+
+    days = max(1, min(days, 365))
+    top = max(1, min(top, 100))
+    since = (datetime.now(timezone.utc) - timedelta(days=days)).replace(minute=0, second=0, microsecond=0)
+    try:
+        async with get_db_connection() as conn:
+            if not conn:
+                return JSONResponse(status_code=503, content={"error": "Database not configured"})
+            with metrics.timer("wcgr_db_query_seconds", query="stats"):
+                hourly = await conn.fetch(STATS_HOURLY_SQL, since)
+                breakdown = await conn.fetch(STATS_BREAKDOWN_SQL, since)
+                # History is keyed by client IP, so raw addresses are only for authenticated callers
+                top_ips = await conn.fetch(STATS_TOP_IPS_SQL, since.date(), top) if token else None
+    except Exception as e:
+        print(f"Stats fetch error: {e}")
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    def averages(row) -> dict:
+        requests = row["requests"] or 0
+        return {
+            "requests": requests,
+            "avg_response_chars": round(row["response_chars"] / requests, 1) if requests else None,
+            "max_response_chars": row["response_chars_max"],
+            "tokens": row["tokens"],
+            "avg_latency_ms": round(row["latency_ms_total"] / requests, 1) if requests else None,
+        }
+
+    totals = {"requests": 0, "response_chars": 0, "response_chars_max": 0, "tokens": 0, "latency_ms_total": 0}
+    for row in breakdown:
+        for name in ("requests", "response_chars", "tokens", "latency_ms_total"):
+            totals[name] += row[name]
+        totals["response_chars_max"] = max(totals["response_chars_max"], row["response_chars_max"])
+
+    payload = {
+        "since": since.isoformat(),
+        "days": days,
+        "totals": averages(totals),
+        "hourly": [{"hour": row["bucket"].isoformat(), "requests": row["requests"]} for row in hourly],
+        "breakdown": [
+            dict(averages(row), horizon=row["horizon"], severity=row["severity"], model_used=row["model_used"])
+            for row in breakdown
+        ],
+    }
+    if top_ips is not None:
+        payload["top_ips"] = [{"ip_address": row["ip_address"], "requests": row["requests"]} for row in top_ips]
+    return JSONResponse(content=payload)
+
+# Last statement of the module: everything above counts as import time
+cold_start["import_seconds"] = time.perf_counter() - _IMPORT_STARTED
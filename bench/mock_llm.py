@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Local mock of the provider streaming APIs used by api/index.py.
+
+Speaks just enough HTTP/1.1 (keep-alive, chunked responses) to stand in for:
+  - OpenAI / Groq   POST .../chat/completions
+  - Anthropic       POST .../messages
+  - Gemini          POST .../models/<model>:streamGenerateContent?alt=sse
+
+Point the app at it with OPENAI_BASE_URL / GROQ_BASE_URL / ANTHROPIC_BASE_URL /
+GEMINI_BASE_URL, e.g. GROQ_BASE_URL=http://127.0.0.1:9100/openai/v1.
+"""
+import argparse
+import asyncio
+import json
+import random
+
+
+class MockLLMServer:
+    def __init__(self, host="127.0.0.1", port=9100, ttft_ms=200.0, tokens=200, token_rate=100.0, error_rate=0.0):
+        self.host = host
+        self.port = port
+        self.ttft = ttft_ms / 1000
+        self.tokens = tokens
+        self.token_interval = 1.0 / token_rate if token_rate > 0 else 0.0
+        self.error_rate = error_rate
+        self.requests = 0
+        self._server = None
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would otherwise keep wait_closed() waiting
+            for task in list(self._handlers):
+                task.cancel()
+            await asyncio.gather(*self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                await self._respond(writer, target)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    async def _respond(self, writer, target: str):
+        if self.error_rate and random.random() < self.error_rate:
+            body = b'{"error": "rate limited"}'
+            writer.write(
+                b"HTTP/1.1 429 Too Many Requests\r\nContent-Type: application/json\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            return
+
+        if ":streamGenerateContent" in target:
+            frames = self._gemini_frames()
+        elif target.split("?")[0].endswith("/messages"):
+            frames = self._anthropic_frames()
+        else:
+            frames = self._openai_frames()
+
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            b"Transfer-Encoding: chunked\r\nConnection: keep-alive\r\n\r\n"
+        )
+        await writer.drain()
+        await asyncio.sleep(self.ttft)
+        for index, frame in enumerate(frames):
+            if index and self.token_interval:
+                await asyncio.sleep(self.token_interval)
+            data = frame.encode("utf-8")
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    def _words(self):
+        return (f"token{i} " for i in range(self.tokens))
+
+    def _openai_frames(self):
+        for word in self._words():
+            yield "data: " + json.dumps({"choices": [{"delta": {"content": word}}]}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    def _anthropic_frames(self):
+        yield "event: message_start\ndata: " + json.dumps({"type": "message_start"}) + "\n\n"
+        for word in self._words():
+            delta = {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}}
+            yield "event: content_block_delta\ndata: " + json.dumps(delta) + "\n\n"
+        yield "event: message_stop\ndata: " + json.dumps({"type": "message_stop"}) + "\n\n"
+
+    def _gemini_frames(self):
+        for word in self._words():
+            yield "data: " + json.dumps({"candidates": [{"content": {"parts": [{"text": word}]}}]}) + "\n\n"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--ttft-ms", type=float, default=200.0)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-rate", type=float, default=100.0, help="tokens per second")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with a 429")
+    args = parser.parse_args()
+
+    server = await MockLLMServer(args.host, args.port, args.ttft_ms, args.tokens, args.token_rate, args.error_rate).start()
+    print(f"Mock LLM server listening on {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Local stand-in for a Redis server, for exercising SHARED_STATE_URL=redis://...
+
+Speaks RESP2 and implements only the commands api/index.py sends: PING, AUTH,
+SELECT, GET, SET (with PX/EX), DEL, INCRBY and PEXPIRE. Keys expire lazily on
+access, plus a periodic sweep.
+
+    python bench/mock_redis.py --port 6399
+    SHARED_STATE_URL=redis://127.0.0.1:6399/0 uvicorn api.index:app --workers 4
+"""
+import argparse
+import asyncio
+import time
+
+
+class MockRedisServer:
+    def __init__(self, host="127.0.0.1", port=6379, password=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.commands = 0
+        self._data = {}
+        self._expires = {}
+        self._server = None
+        self._sweeper = None
+        self._handlers = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._sweeper = asyncio.create_task(self._sweep())
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._sweeper.cancel()
+            for task in list(self._handlers):
+                task.cancel()
+            await asyncio.gather(self._sweeper, *self._handlers, return_exceptions=True)
+            await self._server.wait_closed()
+
+    @property
+    def url(self):
+        auth = f":{self.password}@" if self.password else ""
+        return f"redis://{auth}{self.host}:{self.port}/0"
+
+    async def _sweep(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for key in [key for key, at in self._expires.items() if at <= now]:
+                self._remove(key)
+
+    def _remove(self, key):
+        self._data.pop(key, None)
+        self._expires.pop(key, None)
+
+    def _live(self, key):
+        at = self._expires.get(key)
+        if at is not None and at <= time.monotonic():
+            self._remove(key)
+        return self._data.get(key)
+
+    async def _read_command(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(length + 2))[:-2])
+        return args
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        authed = self.password is None
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if not args:
+                    break
+                self.commands += 1
+                name = args[0].decode().upper()
+                if name == "AUTH":
+                    authed = args[-1].decode() == self.password
+                    reply = "+OK" if authed else "-WRONGPASS invalid password"
+                elif not authed:
+                    reply = "-NOAUTH Authentication required."
+                else:
+                    reply = self._execute(name, args[1:])
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._handlers.discard(task)
+            writer.close()
+
+    def _execute(self, name, args):
+        if name == "PING":
+            return "+PONG"
+        if name == "SELECT":
+            return "+OK"
+        if name == "GET":
+            return self._live(args[0])
+        if name == "SET":
+            key, value = args[0], args[1]
+            self._data[key] = value
+            self._expires.pop(key, None)
+            options = [arg.decode().upper() for arg in args[2:]]
+            for option, unit in (("PX", 1000), ("EX", 1)):
+                if option in options:
+                    self._expires[key] = time.monotonic() + int(options[options.index(option) + 1]) / unit
+            return "+OK"
+        if name == "DEL":
+            removed = sum(1 for key in args if self._live(key) is not None)
+            for key in args:
+                self._remove(key)
+            return removed
+        if name == "INCRBY":
+            current = self._live(args[0])
+            try:
+                value = int(current or 0) + int(args[1])
+            except ValueError:
+                return "-ERR value is not an integer or out of range"
+            self._data[args[0]] = str(value).encode()
+            return value
+        if name == "PEXPIRE":
+            if self._live(args[0]) is None:
+                return 0
+            self._expires[args[0]] = time.monotonic() + int(args[1]) / 1000
+            return 1
+        return f"-ERR unknown command '{name}'"
+
+    @staticmethod
+    def _encode(reply) -> bytes:
+        if reply is None:
+            return b"$-1\r\n"
+        if isinstance(reply, int):
+            return f":{reply}\r\n".encode()
+        if isinstance(reply, bytes):
+            return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
+        return reply.encode() + b"\r\n"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--password")
+    args = parser.parse_args()
+
+    server = await MockRedisServer(args.host, args.port, args.password).start()
+    print(f"Mock Redis server listening on {server.url}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
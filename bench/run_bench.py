@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""Offline load test for api/index.py.
+
+Starts the mock LLM server (bench/mock_llm.py) and the app under uvicorn, points
+every provider at the mock and then drives /api/predict and /api/history at
+increasing concurrency. Reports throughput, p50/p95/p99
+time-to-first-token and the app's event-loop lag (from /api/metrics) per level.
+A warm-up request goes first, and each level runs for at least --min-seconds so
+the loop-lag p99 has enough samples behind it.
+
+    python bench/run_bench.py --provider groq --concurrency 1,8,32,128 --requests 200
+    python bench/run_bench.py --json bench_result.json --max-ttft-p99-ms 800
+    python bench/run_bench.py --workers 4 --shared-state redis --cache --same-prompt
+
+Exits non-zero when a --max-* threshold is exceeded, so it can gate CI.
+Set POSTGRES_URL to include the database paths; without it predictions are not
+persisted and history returns without touching a database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_llm import MockLLMServer  # noqa: E402
+from mock_redis import MockRedisServer  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def ms(value):
+    return None if value is None else round(value * 1000, 1)
+
+
+def parse_histogram(text: str, name: str):
+    """Cumulative bucket counts of an unlabelled histogram from Prometheus text."""
+    buckets = {}
+    for line in text.splitlines():
+        if line.startswith(name + "_bucket{"):
+            labels, value = line.rsplit(" ", 1)
+            bound = labels.split('le="', 1)[1].split('"', 1)[0]
+            buckets[float("inf") if bound == "+Inf" else float(bound)] = float(value)
+    return buckets
+
+
+def histogram_percentile(before: dict, after: dict, pct: float):
+    bounds = sorted(after)
+    deltas = [(bound, after[bound] - before.get(bound, 0.0)) for bound in bounds]
+    if not deltas or deltas[-1][1] <= 0:
+        return None
+    target = deltas[-1][1] * pct / 100
+    for bound, cumulative in deltas:
+        if cumulative >= target:
+            return bound
+    return None
+
+
+def start_app(args, mock_url: str, port: int, shared_state_url: str = None):
+    env = dict(os.environ)
+    env.update({
+        "LLM_PROVIDER": args.provider,
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"{mock_url}/v1",
+        "GROQ_API_KEY": "bench",
+        "GROQ_BASE_URL": f"{mock_url}/openai/v1",
+        "ANTHROPIC_API_KEY": "bench",
+        "ANTHROPIC_BASE_URL": f"{mock_url}/v1",
+        "GEMINI_API_KEY": "bench",
+        "GEMINI_BASE_URL": f"{mock_url}/v1beta",
+        "HEDGE_ENABLED": "0",
+    })
+    # Every simulated client shares one IP and each level is larger than the
+    # default queue, so admission control is opened up unless set explicitly
+    env.setdefault("RATE_LIMIT_RPS", "0")
+    env.setdefault("PROVIDER_MAX_QUEUE", "10000")
+    # Sample the loop often enough that even a short level yields a usable p99
+    env.setdefault("LOOP_LAG_INTERVAL", "0.01")
+    if not args.cache:
+        env["FORECAST_CACHE_TTL"] = "0"
+        env["SIMILAR_THRESHOLD"] = "0"
+    if shared_state_url:
+        env["SHARED_STATE_URL"] = shared_state_url
+    cmd = [sys.executable, "-m", "uvicorn", "api.index:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+           "--workers", str(args.workers)]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env)
+
+
+async def wait_ready(client: httpx.AsyncClient, process, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("app exited during startup")
+        try:
+            if (await client.get("/api/ping")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("app did not become ready")
+
+
+async def warm_up(client: httpx.AsyncClient):
+    """One prediction and one history read, so lazy imports and first connections
+    are paid for before anything is measured."""
+    headers = {"x-forwarded-for": "10.255.255.1"}
+    async with client.stream("POST", "/api/predict", json={"text": "bench warm-up"}, headers=headers) as resp:
+        async for _ in resp.aiter_lines():
+            pass
+    await client.get("/api/history?limit=50", headers=headers)
+
+
+async def run_level(client: httpx.AsyncClient, concurrency: int, total: int, same_prompt: bool, min_seconds: float):
+    ttfts, durations, history_latencies = [], [], []
+    errors = {"predict": 0, "history": 0}
+    ip = f"10.{concurrency % 256}.0.1"
+
+    async def predict(i: int):
+        text = "bench prompt" if same_prompt else f"bench prompt {concurrency}-{i}-{time.monotonic_ns()}"
+        first = None
+        failed = False
+        start = time.perf_counter()
+        try:
+            async with client.stream("POST", "/api/predict", json={"text": text}, headers={"x-forwarded-for": ip}) as resp:
+                if resp.status_code != 200:
+                    failed = True
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data: "):
+                        continue
+                    if '"error"' in line:
+                        failed = True
+                    elif first is None:
+                        first = time.perf_counter() - start
+        except httpx.HTTPError:
+            failed = True
+        if failed or first is None:
+            errors["predict"] += 1
+            return
+        ttfts.append(first)
+        durations.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        try:
+            resp = await client.get("/api/history?limit=50", headers={"x-forwarded-for": ip})
+            resp.raise_for_status()
+            history_latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            errors["history"] += 1
+
+    before = parse_histogram((await client.get("/api/metrics")).text, "wcgr_event_loop_lag_seconds")
+    started = time.perf_counter()
+    issued = 0
+
+    async def simulated_client():
+        # Keeps going past `total` until the level has run for min_seconds
+        nonlocal issued
+        while issued < total or time.perf_counter() - started < min_seconds:
+            issued += 1
+            await predict(issued)
+
+    await asyncio.gather(*(simulated_client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    after = parse_histogram((await client.get("/api/metrics")).text, "wcgr_event_loop_lag_seconds")
+
+    return {
+        "concurrency": concurrency,
+        "requests": issued,
+        "elapsed_s": round(elapsed, 3),
+        "predict_rps": round(len(durations) / elapsed, 2) if elapsed else None,
+        "ttft_p50_ms": ms(percentile(ttfts, 50)),
+        "ttft_p95_ms": ms(percentile(ttfts, 95)),
+        "ttft_p99_ms": ms(percentile(ttfts, 99)),
+        "stream_p99_ms": ms(percentile(durations, 99)),
+        "history_p99_ms": ms(percentile(history_latencies, 99)),
+        "loop_lag_p99_ms": ms(histogram_percentile(before, after, 99)),
+        "loop_lag_samples": int(after.get(float("inf"), 0.0) - before.get(float("inf"), 0.0)),
+        "errors": errors,
+    }
+
+
+COLUMNS = ["concurrency", "predict_rps", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms", "stream_p99_ms",
+           "history_p99_ms", "loop_lag_p99_ms"]
+
+
+def print_header():
+    print(" ".join(f"{c:>16}" for c in COLUMNS) + "  errors", flush=True)
+
+
+def print_row(row):
+    print(" ".join(f"{str(row[c]):>16}" for c in COLUMNS) + f"  {row['errors']}", flush=True)
+
+
+MIN_LOOP_LAG_SAMPLES = 100
+
+
+def check_thresholds(args, results):
+    failures = []
+    for row in results:
+        checks = (("ttft_p99_ms", args.max_ttft_p99_ms), ("loop_lag_p99_ms", args.max_loop_lag_p99_ms))
+        for key, limit in checks:
+            if limit is not None and row[key] is not None and row[key] > limit:
+                failures.append(f"c={row['concurrency']}: {key} {row[key]} > {limit}")
+        # A p99 over a handful of timer wake-ups is just the worst one
+        if args.max_loop_lag_p99_ms is not None and row["loop_lag_samples"] < MIN_LOOP_LAG_SAMPLES:
+            failures.append(f"c={row['concurrency']}: only {row['loop_lag_samples']} loop-lag samples "
+                            f"(need {MIN_LOOP_LAG_SAMPLES}; lower LOOP_LAG_INTERVAL or raise --min-seconds)")
+        if args.max_error_rate is not None and row["requests"]:
+            rate = row["errors"]["predict"] / row["requests"]
+            if rate > args.max_error_rate:
+                failures.append(f"c={row['concurrency']}: predict error rate {rate:.3f} > {args.max_error_rate}")
+    return failures
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--provider", default="groq", choices=["groq", "openai", "anthropic", "gemini"])
+    parser.add_argument("--concurrency", default="1,8,32,128", help="comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="predictions per level")
+    parser.add_argument("--min-seconds", type=float, default=5.0,
+                        help="keep each level running at least this long, so loop-lag p99 has enough samples")
+    parser.add_argument("--ttft-ms", type=float, default=200.0, help="mock time to first token")
+    parser.add_argument("--tokens", type=int, default=100, help="mock tokens per response")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="mock tokens per second")
+    parser.add_argument("--same-prompt", action="store_true", help="send identical prompts (exercises coalescing)")
+    parser.add_argument("--cache", action="store_true", help="leave the forecast cache and similar-input index enabled")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--shared-state", choices=["none", "sqlite", "redis"], default="none",
+                        help="share caches and limits across workers (redis uses bench/mock_redis.py)")
+    parser.add_argument("--json", help="also write results to this file")
+    parser.add_argument("--max-ttft-p99-ms", type=float)
+    parser.add_argument("--max-loop-lag-p99-ms", type=float)
+    parser.add_argument("--max-error-rate", type=float)
+    args = parser.parse_args()
+
+    mock = await MockLLMServer(port=0, ttft_ms=args.ttft_ms, tokens=args.tokens, token_rate=args.token_rate).start()
+    redis = None
+    shared_state_url = None
+    if args.shared_state == "redis":
+        redis = await MockRedisServer(port=0).start()
+        shared_state_url = redis.url
+    elif args.shared_state == "sqlite":
+        shared_state_url = f"sqlite://{os.path.join(tempfile.mkdtemp(prefix='wcgr-bench-'), 'state.db')}"
+    port = free_port()
+    process = start_app(args, mock.url, port, shared_state_url)
+    levels = [int(level) for level in args.concurrency.split(",") if level.strip()]
+    limits = httpx.Limits(max_connections=max(levels) + 4, max_keepalive_connections=max(levels) + 4)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=120) as client:
+            await wait_ready(client, process)
+            await warm_up(client)
+            results = []
+            print_header()
+            for level in levels:
+                results.append(await run_level(client, level, args.requests, args.same_prompt, args.min_seconds))
+                print_row(results[-1])
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        await mock.close()
+        if redis is not None:
+            await redis.close()
+
+    report = {
+        "provider": args.provider,
+        "workers": args.workers,
+        "shared_state": args.shared_state,
+        "mock": {"ttft_ms": args.ttft_ms, "tokens": args.tokens, "token_rate": args.token_rate, "upstream_requests": mock.requests},
+        "levels": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failures = check_thresholds(args, results)
+    for failure in failures:
+        print(f"THRESHOLD EXCEEDED: {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -3,6 +3,41 @@ import os
 import psycopg2
 import sys
 
+def report_partitions(cursor):
+    print("\nPartitions of 'queries':")
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('queries')")
+    row = cursor.fetchone()
+    if not row or row[0] != 'p':
+        print(" 'queries' is not partitioned (run `python migrate.py`).")
+        return
+
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), pg_total_relation_size(c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'queries'::regclass
+        ORDER BY c.relname
+    """)
+    partitions = cursor.fetchall()
+    total_rows = 0
+    total_bytes = 0
+    for name, bound, size in partitions:
+        cursor.execute(f'SELECT COUNT(*) FROM "{name}"')
+        rows = cursor.fetchone()[0]
+        total_rows += rows
+        total_bytes += size
+        print(f" - {name}: {rows} rows, {size / 1024 / 1024:.1f} MiB ({bound})")
+    print(f" Total: {len(partitions)} partitions, {total_rows} rows, {total_bytes / 1024 / 1024:.1f} MiB")
+
+    # Left behind by a retention run that stopped before exporting them
+    cursor.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND relname ~ '^queries_y[0-9]{4}m[0-9]{2}$'
+          AND oid NOT IN (SELECT inhrelid FROM pg_inherits)
+    """)
+    detached = [row[0] for row in cursor.fetchall()]
+    if detached:
+        print(f" Detached, not yet archived: {', '.join(detached)}")
+
 def check_db():
     url = os.environ.get("POSTGRES_URL")
     if not url:
@@ -32,6 +67,8 @@ def check_db():
         else:
             print("\nFAILURE: 'ip_address' column MISSING.")
 
+        report_partitions(cursor)
+
         # Check recent rows
         print("\nCreating a test query from this script to check insertion...")
         try:
@@ -0,0 +1,33 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from api import index  # noqa: E402
+
+async def migrate():
+    if not os.environ.get("POSTGRES_URL"):
+        print("ERROR: POSTGRES_URL environment variable not set.")
+        return 1
+
+    async with index.get_db_connection() as conn:
+        if not conn:
+            print("ERROR: could not connect to the database.")
+            return 1
+        applied = await index.apply_migrations(conn)
+        version = await index.current_schema_version(conn)
+        # Also the cron entry point for creating partitions ahead and archiving old ones
+        partitions = await index.maintain_partitions(conn)
+    index.write_schema_marker()
+    await index.shutdown()
+
+    if applied:
+        print(f"Applied migrations {applied}; schema is at version {version}.")
+    else:
+        print(f"Schema is up to date (version {version}).")
+    if partitions["created"] or partitions["archived"]:
+        print(f"Created partitions {partitions['created']}; archived {partitions['archived']}.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(migrate()))
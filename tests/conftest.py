@@ -0,0 +1,106 @@
+import asyncio
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+# api/index.py reads these at import time: the tests run without a database,
+# shared state or the Vercel defaults, whatever the calling shell has exported
+for name in ("POSTGRES_URL", "SHARED_STATE_URL", "VERCEL", "LLM_FALLBACK_PROVIDERS"):
+    os.environ.pop(name, None)
+os.environ["FAST_START"] = "1"
+
+
+@pytest.fixture(scope="session")
+def client():
+    # One app lifetime for the whole run: the module's queues and locks bind to
+    # the first event loop that uses them, as they would in a worker process
+    from api import index
+    with TestClient(index.app) as client:
+        yield client
+
+
+class Clock:
+    """Stands in for time.monotonic so state machines can be stepped through time."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    from api import index
+    clock = Clock()
+    monkeypatch.setattr(index.time, "monotonic", clock)
+    return clock
+
+
+# Paging through the API against a real database: set TEST_POSTGRES_URL to a
+# scratch database (migrations are applied to it)
+TEST_POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL", "")
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    """Seeds 23 queries for a fresh client IP and yields that IP."""
+    if not TEST_POSTGRES_URL:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    import asyncpg
+    from api import index
+
+    ip_address = f"test-{uuid.uuid4().hex[:12]}"
+    start = datetime.now(timezone.utc).replace(microsecond=0)
+
+    async def seed():
+        conn = await asyncpg.connect(TEST_POSTGRES_URL)
+        try:
+            await index.apply_migrations(conn)
+            rows = []
+            for i in range(23):
+                # Groups of identical timestamps, so pages have to break ties on id
+                created_at = start - timedelta(seconds=i // 4)
+                text = "production database " + ("migration " * (i % 5)) + f"case {i}"
+                rows.append((text, "mid", "realistic", "groq/test", "preview", ip_address, created_at,
+                             "forecast", "groq", 1, 1))
+            await conn.executemany(index.INSERT_QUERY_SQL, rows)
+        finally:
+            await conn.close()
+
+    async def clean():
+        conn = await asyncpg.connect(TEST_POSTGRES_URL)
+        try:
+            await conn.execute("DELETE FROM queries WHERE ip_address = $1", ip_address)
+        finally:
+            await conn.close()
+
+    asyncio.run(seed())
+    monkeypatch.setenv("POSTGRES_URL", TEST_POSTGRES_URL)
+    monkeypatch.setenv("SCHEMA_MARKER_PATH", str(tmp_path / "schema-marker"))
+    yield ip_address
+    asyncio.run(clean())
+
+
+@pytest.fixture
+def pages(client):
+    """Follow next_cursor from `path` to the end; returns every id in order."""
+    def follow(path, ip_address, cursor_param):
+        ids, cursor = [], None
+        while True:
+            url = path + (f"&{cursor_param}={cursor}" if cursor else "")
+            payload = client.get(url, headers={"x-forwarded-for": ip_address}).json()
+            assert "error" not in payload
+            ids.extend(query["id"] for query in payload["queries"])
+            cursor = payload["next_cursor"]
+            if cursor is None:
+                return ids
+    return follow
@@ -0,0 +1,96 @@
+import asyncio
+import json
+
+import pytest
+
+from api import index
+
+
+@pytest.fixture
+def batch(monkeypatch):
+    """Items are answered by a fake forecast_stream; "fail" makes the upstream error."""
+    monkeypatch.setenv("RATE_LIMIT_RPS", "0")
+    monkeypatch.setattr(index, "rate_limiter", index.RateLimiter())
+    active = {"now": 0, "peak": 0}
+
+    async def forecast_stream(text, horizon, severity, provider, backup=None):
+        active["now"] += 1
+        active["peak"] = max(active["peak"], active["now"])
+        try:
+            await asyncio.sleep(0.02)
+            if text == "fail":
+                yield {'error': "upstream failed"}
+                return
+            yield {'output': f"{text}/{horizon}/{severity}"}
+        finally:
+            active["now"] -= 1
+
+    monkeypatch.setattr(index, "forecast_stream", forecast_stream)
+    return active
+
+
+def post_batch(client, body):
+    response = client.post("/api/predict/batch", json=body)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines() if line]
+
+
+@pytest.mark.parametrize("body, error", [
+    ({}, "Missing 'items'"),
+    ({"items": []}, "Missing 'items'"),
+    ({"items": "text"}, "Missing 'items'"),
+    ({"items": [{"text": "a"}], "concurrency": "lots"}, "Invalid 'concurrency'"),
+])
+def test_invalid_batches_are_rejected(client, batch, body, error):
+    response = client.post("/api/predict/batch", json=body)
+    assert response.status_code == 400
+    assert response.json() == {"error": error}
+
+
+def test_invalid_json_is_rejected(client, batch):
+    response = client.post("/api/predict/batch", content=b"{")
+    assert response.status_code == 400
+    assert response.json() == {"error": "Invalid JSON"}
+
+
+def test_too_many_items_are_rejected(client, batch, monkeypatch):
+    monkeypatch.setenv("BATCH_MAX_ITEMS", "2")
+    response = client.post("/api/predict/batch", json={"items": [{"text": "a"}] * 3})
+    assert response.status_code == 400
+    assert response.json() == {"error": "At most 2 items per batch"}
+
+
+def test_failing_items_only_fail_themselves(client, batch):
+    events = post_batch(client, {"items": [
+        {"text": "a"},
+        "not an object",
+        {"text": "   "},
+        {"text": "b", "horizon": 3},
+        {"text": "fail"},
+        {"text": "c", "horizon": "far", "severity": "worst"},
+    ]})
+    by_index = {}
+    for event in events[:-1]:
+        by_index.setdefault(event.pop('index'), []).append(event)
+
+    assert by_index[0] == [{'output': "a/mid/realistic"}, {'done': True}]
+    assert by_index[1] == [{'error': "Invalid item"}, {'done': True}]
+    assert by_index[2] == [{'error': "Missing 'text'"}, {'done': True}]
+    assert by_index[3] == [{'error': "Invalid 'horizon'"}, {'done': True}]
+    assert by_index[4] == [{'error': "upstream failed"}, {'done': True}]
+    assert by_index[5] == [{'output': "c/far/worst"}, {'done': True}]
+    assert events[-1] == {'done': True, 'completed': 2, 'failed': 4}
+
+
+def test_items_run_at_most_concurrency_at_a_time(client, batch, monkeypatch):
+    monkeypatch.setenv("BATCH_MAX_CONCURRENCY", "4")
+    events = post_batch(client, {"items": [{"text": f"item {i}"} for i in range(10)], "concurrency": 2})
+    assert events[-1] == {'done': True, 'completed': 10, 'failed': 0}
+    assert batch["peak"] == 2
+
+
+def test_sse_format_frames_every_event(client, batch):
+    response = client.post("/api/predict/batch", json={"items": [{"text": "a"}], "format": "sse"})
+    frames = [json.loads(line.removeprefix("data: ")) for line in response.text.splitlines() if line]
+    assert frames == [{'output': "a/mid/realistic", 'index': 0}, {'index': 0, 'done': True},
+                      {'done': True, 'completed': 1, 'failed': 0}]
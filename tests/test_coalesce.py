@@ -0,0 +1,81 @@
+import asyncio
+
+import pytest
+
+from api import index
+from mock_llm import MockLLMServer
+
+
+@pytest.fixture(autouse=True)
+def coalescing(monkeypatch):
+    monkeypatch.setenv("SSE_COALESCE_MS", "50")
+    monkeypatch.setenv("SSE_COALESCE_BYTES", "2048")
+
+
+async def timed(events):
+    """Yield (delay, event) pairs, sleeping `delay` seconds before each event."""
+    for delay, event in events:
+        await asyncio.sleep(delay)
+        yield event
+
+
+def coalesced(events):
+    async def collect():
+        return [event async for event in index.coalesce_events(timed(events))]
+    return asyncio.run(collect())
+
+
+def test_first_delta_is_sent_alone_and_the_rest_merged():
+    frames = coalesced([(0, {'output': "a"}), (0, {'output': "b"}), (0, {'output': "c"}), (0, {'output': "d"})])
+    assert frames == [{'output': "a"}, {'output': "bcd"}]
+
+
+def test_buffer_is_flushed_when_the_window_elapses():
+    frames = coalesced([(0, {'output': "a"}), (0, {'output': "b"}), (0.2, {'output': "c"})])
+    assert frames == [{'output': "a"}, {'output': "b"}, {'output': "c"}]
+
+
+def test_other_events_flush_the_buffer_and_pass_through():
+    frames = coalesced([
+        (0, {'output': "a"}),
+        (0, {'output': "b"}),
+        (0, {'winner': "groq"}),
+        (0, {'output': "c"}),
+        (0, {'error': "boom"}),
+    ])
+    assert frames == [{'output': "a"}, {'output': "b"}, {'winner': "groq"}, {'output': "c"}, {'error': "boom"}]
+
+
+def test_cached_output_is_not_merged():
+    frames = coalesced([(0, {'output': "a"}), (0, {'output': "whole answer", 'cached': True})])
+    assert frames == [{'output': "a"}, {'output': "whole answer", 'cached': True}]
+
+
+def test_byte_limit_flushes_early(monkeypatch):
+    monkeypatch.setenv("SSE_COALESCE_BYTES", "4")
+    frames = coalesced([(0, {'output': "a"}), (0, {'output': "bb"}), (0, {'output': "cc"}), (0, {'output': "d"})])
+    assert frames == [{'output': "a"}, {'output': "bbcc"}, {'output': "d"}]
+
+
+def test_zero_window_passes_events_through(monkeypatch):
+    monkeypatch.setenv("SSE_COALESCE_MS", "0")
+    events = [(0, {'output': "a"}), (0, {'output': "b"}), (0, {'output': "c"})]
+    assert coalesced(events) == [event for _, event in events]
+
+
+def test_provider_stream_from_mock_llm_is_coalesced_losslessly(monkeypatch):
+    async def run():
+        mock = await MockLLMServer(port=0, ttft_ms=10, tokens=60, token_rate=500).start()
+        monkeypatch.setenv("GROQ_API_KEY", "test")
+        monkeypatch.setenv("GROQ_BASE_URL", mock.url + "/openai/v1")
+        try:
+            config = {"deadline": index.Deadline()}
+            return [event async for event in index.coalesce_events(index.provider_stream("groq", "prompt", config))]
+        finally:
+            await index.close_http_client()
+            await mock.close()
+
+    frames = asyncio.run(run())
+    assert "".join(frame['output'] for frame in frames) == "".join(f"token{i} " for i in range(60))
+    assert frames[0] == {'output': "token0 "}
+    assert len(frames) < 60
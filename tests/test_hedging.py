@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+import pytest
+
+from api import index
+from mock_llm import MockLLMServer
+
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setenv("HEDGE_DEADLINE_MS", "100")
+    monkeypatch.setattr(index, "metrics", index.Metrics())
+    monkeypatch.setattr(index, "provider_health", {name: index.ProviderHealth(name) for name in index.PROVIDER_STREAMS})
+
+
+def cancelled(provider: str, reason: str) -> float:
+    return sum(value for (name, labels), value in index.metrics._values.items()
+               if name == "wcgr_streams_cancelled_total" and ("provider", provider) in labels and ("reason", reason) in labels)
+
+
+def hedge(monkeypatch, primary: dict, backup: dict):
+    """Run hedged_stream with groq (primary) and openai (backup) served by two mocks."""
+    async def run():
+        slow = await MockLLMServer(port=0, **primary).start()
+        fast = await MockLLMServer(port=0, **backup).start()
+        monkeypatch.setenv("GROQ_API_KEY", "test")
+        monkeypatch.setenv("GROQ_BASE_URL", slow.url + "/openai/v1")
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", fast.url + "/v1")
+        started = time.monotonic()
+        try:
+            config = {"deadline": index.Deadline()}
+            events = [event async for event in index.hedged_stream("groq", "openai", "prompt", config)]
+            # Give the cancelled loser's cleanup a turn
+            await asyncio.sleep(0.05)
+            return events, time.monotonic() - started, slow.requests, fast.requests
+        finally:
+            await index.close_http_client()
+            await slow.close()
+            await fast.close()
+
+    return asyncio.run(run())
+
+
+def test_backup_wins_and_the_slow_primary_is_cancelled(monkeypatch, hedging):
+    events, elapsed, primary_calls, backup_calls = hedge(
+        monkeypatch, dict(ttft_ms=3000, tokens=5), dict(ttft_ms=10, tokens=5, token_rate=1000))
+    assert events[0] == {'hedged': True, 'winner': "openai"}
+    assert "".join(event['output'] for event in events[1:]) == "".join(f"token{i} " for i in range(5))
+    assert (primary_calls, backup_calls) == (1, 1)
+    # Nothing waited for the primary's first token
+    assert elapsed < 2
+    assert cancelled("groq", "hedge_lost") == 1
+    # Losing a hedge is not a provider failure
+    assert index.provider_health["groq"].snapshot()["errors"] == 0
+
+
+def test_fast_primary_never_starts_the_backup(monkeypatch, hedging):
+    events, _, primary_calls, backup_calls = hedge(
+        monkeypatch, dict(ttft_ms=10, tokens=5, token_rate=1000), dict(ttft_ms=10, tokens=5))
+    assert events[0] == {'hedged': False, 'winner': "groq"}
+    assert (primary_calls, backup_calls) == (1, 0)
+    assert cancelled("openai", "hedge_lost") == 0
+
+
+def test_primary_failure_starts_the_backup_right_away(monkeypatch, hedging):
+    monkeypatch.setenv("HEDGE_DEADLINE_MS", "5000")
+    events, elapsed, primary_calls, backup_calls = hedge(
+        monkeypatch, dict(ttft_ms=10, error_rate=1.0), dict(ttft_ms=10, tokens=3, token_rate=1000))
+    assert events[0] == {'hedged': True, 'winner': "openai"}
+    assert len(events) == 4
+    assert (primary_calls, backup_calls) == (1, 1)
+    assert elapsed < 2
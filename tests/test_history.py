@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from api import index
+
+
+def test_history_cursor_round_trips():
+    created_at = datetime(2026, 3, 14, 15, 9, 26, 535897, tzinfo=timezone(timedelta(hours=2)))
+    cursor = index.format_history_cursor(created_at, 4242)
+    assert cursor == "2026-03-14T13:09:26.535897Z,4242"
+    assert index.parse_history_cursor(cursor) == (created_at, 4242)
+
+
+def test_history_cursor_is_url_safe():
+    cursor = index.format_history_cursor(datetime(2026, 1, 1, tzinfo=timezone(timedelta(hours=-5))), 1)
+    assert not set(cursor) & set("+ /?&#")
+
+
+@pytest.mark.parametrize("before", ["yesterday", "2026-01-01T00:00:00Z,abc"])
+def test_malformed_history_cursors_are_rejected(client, before):
+    response = client.get(f"/api/history?before={before}")
+    assert response.status_code == 400
+    assert response.json() == {"error": "Invalid 'before' cursor"}
+
+
+def test_history_pages_cover_every_row_once(client, database, pages):
+    everything = client.get("/api/history?limit=100", headers={"x-forwarded-for": database}).json()["queries"]
+    assert len(everything) == 23
+    assert pages("/api/history?limit=5", database, "before") == [query["id"] for query in everything]
+
+
+@pytest.fixture
+def history_cache(monkeypatch, clock):
+    monkeypatch.setenv("HISTORY_CACHE_TTL", "10")
+    monkeypatch.setenv("HISTORY_CACHE_MAX_PAGES", "3")
+    monkeypatch.setenv("HISTORY_CACHE_MAX_IPS", "2")
+    return index.HistoryCache()
+
+
+def test_history_cache_keeps_the_most_recently_used_pages_per_ip(history_cache):
+    for page in range(3):
+        history_cache.put("1.1.1.1", (page,), {"page": page})
+    assert history_cache.get("1.1.1.1", (0,)) == {"page": 0}
+    history_cache.put("1.1.1.1", (3,), {"page": 3})
+    assert len(history_cache) == 3
+    assert history_cache.get("1.1.1.1", (1,)) is None
+    assert [history_cache.get("1.1.1.1", (page,)) for page in (0, 2, 3)] == [{"page": 0}, {"page": 2}, {"page": 3}]
+
+
+def test_history_cache_prunes_expired_pages_on_put(history_cache, clock):
+    history_cache.put("1.1.1.1", (0,), {"page": 0})
+    history_cache.put("1.1.1.1", (1,), {"page": 1})
+    clock.now += 11
+    history_cache.put("1.1.1.1", (2,), {"page": 2})
+    assert len(history_cache) == 1
+
+
+def test_history_cache_keeps_the_most_recently_active_ips(history_cache):
+    for ip_address in ("1.1.1.1", "2.2.2.2", "3.3.3.3"):
+        history_cache.put(ip_address, (0,), {"ip": ip_address})
+    assert history_cache.get("1.1.1.1", (0,)) is None
+    assert history_cache.get("3.3.3.3", (0,)) == {"ip": "3.3.3.3"}
+    assert len(history_cache) == 2
@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+
+import pytest
+
+from api import index
+
+
+@pytest.mark.parametrize("year, month, count, expected", [
+    (2026, 1, 0, (2026, 1)),
+    (2026, 1, 1, (2026, 2)),
+    (2026, 12, 1, (2027, 1)),
+    (2026, 1, -1, (2025, 12)),
+    (2026, 3, -15, (2024, 12)),
+    (2026, 1, 24, (2028, 1)),
+    (2026, 11, 3, (2027, 2)),
+])
+def test_add_months(year, month, count, expected):
+    assert index.add_months(year, month, count) == expected
+
+
+def test_partition_name_is_zero_padded():
+    assert index.partition_name(2026, 3) == "queries_y2026m03"
+    assert index.partition_name(2026, 12) == "queries_y2026m12"
+
+
+def test_partition_names_round_trip_and_sort_chronologically():
+    months = [index.add_months(2025, 11, count) for count in range(15)]
+    names = [index.partition_name(year, month) for year, month in months]
+    assert names == sorted(names)
+    for (year, month), name in zip(months, names):
+        match = index.PARTITION_NAME.match(name)
+        assert (int(match.group(1)), int(match.group(2))) == (year, month)
+
+
+@pytest.mark.parametrize("name", ["queries", "queries_default", "queries_y2026m3", "queries_old_y2026m03", "queries_y2026m03_idx"])
+def test_other_tables_are_not_taken_for_partitions(name):
+    assert index.PARTITION_NAME.match(name) is None
+
+
+def test_month_bounds_cover_the_month_in_utc():
+    assert index.month_bounds(2026, 12) == (
+        datetime(2026, 12, 1, tzinfo=timezone.utc),
+        datetime(2027, 1, 1, tzinfo=timezone.utc),
+    )
+
+
+def test_consecutive_month_bounds_abut():
+    months = [index.add_months(2026, 1, count) for count in range(13)]
+    bounds = [index.month_bounds(year, month) for year, month in months]
+    for (_, upper), (lower, _) in zip(bounds, bounds[1:]):
+        assert upper == lower
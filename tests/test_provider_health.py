@@ -0,0 +1,160 @@
+import asyncio
+
+import pytest
+
+from api import index
+from mock_llm import MockLLMServer
+
+
+@pytest.fixture
+def breaker_env(monkeypatch):
+    monkeypatch.setenv("BREAKER_FAILURE_THRESHOLD", "3")
+    monkeypatch.setenv("BREAKER_MIN_REQUESTS", "100")
+    monkeypatch.setenv("BREAKER_COOLDOWN", "30")
+    monkeypatch.setenv("PROVIDER_TIMEOUT", "45")
+
+
+@pytest.fixture
+def health(breaker_env, clock):
+    return index.ProviderHealth("groq")
+
+
+def open_breaker(health):
+    for _ in range(health.failure_threshold):
+        health.record_failure("boom", 0.1)
+
+
+def test_breaker_opens_after_consecutive_failures(health):
+    health.record_failure("boom", 0.1)
+    health.record_failure("boom", 0.1)
+    health.record_success(0.05, 0.1)
+    health.record_failure("boom", 0.1)
+    assert health.state == "closed"
+    health.record_failure("boom", 0.1)
+    health.record_failure("boom", 0.1)
+    assert health.state == "open"
+    assert not health.admit()
+
+
+def test_breaker_opens_on_sustained_error_rate(monkeypatch, clock):
+    monkeypatch.setenv("BREAKER_FAILURE_THRESHOLD", "100")
+    monkeypatch.setenv("BREAKER_MIN_REQUESTS", "4")
+    monkeypatch.setenv("HEALTH_EWMA_ALPHA", "0.5")
+    health = index.ProviderHealth("groq")
+    for _ in range(3):
+        health.record_failure("boom", 0.1)
+    assert health.state == "closed"
+    health.record_failure("boom", 0.1)
+    assert health.state == "open"
+
+
+def test_half_open_admits_a_single_probe(health, clock):
+    open_breaker(health)
+    clock.now += 29
+    assert not health.available()
+    clock.now += 1
+    assert health.admit()
+    assert health.state == "half_open"
+    assert not health.admit()
+    assert not health.available()
+
+
+def test_probe_success_closes_the_breaker(health, clock):
+    open_breaker(health)
+    clock.now += 30
+    assert health.admit()
+    health.record_success(0.05, 0.1)
+    assert health.state == "closed"
+    assert health.admit() and health.admit()
+
+
+def test_probe_failure_reopens_for_another_cooldown(health, clock):
+    open_breaker(health)
+    clock.now += 30
+    assert health.admit()
+    health.record_failure("still down", 0.1)
+    assert health.state == "open"
+    clock.now += 29
+    assert not health.admit()
+    clock.now += 1
+    assert health.admit()
+
+
+def test_probe_without_verdict_frees_the_slot(health, clock):
+    open_breaker(health)
+    clock.now += 30
+    assert health.admit()
+    health.release_probe()
+    assert health.admit()
+
+
+def test_unanswered_probe_lapses_after_the_stream_deadline(health, clock):
+    open_breaker(health)
+    clock.now += 30
+    assert health.admit()
+    clock.now += 44
+    assert not health.admit()
+    clock.now += 1
+    assert health.admit()
+
+
+def test_fallback_serves_requests_while_the_probe_is_in_flight(monkeypatch, breaker_env, clock):
+    monkeypatch.setenv("LLM_FALLBACK_PROVIDERS", "openai")
+    monkeypatch.setattr(index, "provider_health", {name: index.ProviderHealth(name) for name in index.PROVIDER_STREAMS})
+    open_breaker(index.provider_health["groq"])
+    assert index.select_provider("groq") == "openai"
+    clock.now += 30
+    # Selecting claims nothing; the probe goes to the first request sent upstream
+    assert [index.select_provider("groq") for _ in range(2)] == ["groq"] * 2
+    assert index.claim_provider("groq") == "groq"
+    assert [index.select_provider("groq") for _ in range(3)] == ["openai"] * 3
+    assert index.claim_provider("groq") == "openai"
+
+
+@pytest.fixture
+def half_open(monkeypatch, breaker_env, clock):
+    monkeypatch.setenv("LLM_FALLBACK_PROVIDERS", "openai")
+    monkeypatch.setattr(index, "provider_health", {name: index.ProviderHealth(name) for name in index.PROVIDER_STREAMS})
+    health = index.provider_health["groq"]
+    open_breaker(health)
+    clock.now += 30
+    return health
+
+
+def test_cache_hit_does_not_claim_the_probe(monkeypatch, half_open):
+    monkeypatch.setattr(index, "forecast_cache", index.ForecastCache())
+    index.forecast_cache.put(index.forecast_key("Friday deploy", "mid", "realistic", "groq"), "cached forecast")
+
+    async def run():
+        return [event async for event in index.forecast_stream("Friday deploy", "mid", "realistic", "groq")]
+
+    assert asyncio.run(run()) == [{'output': "cached forecast", 'cached': True}]
+    assert half_open.probe_started is None
+    assert index.claim_provider("groq") == "groq"
+
+
+def test_hedge_backup_is_claimed_only_when_it_starts(monkeypatch, half_open):
+    monkeypatch.setenv("HEDGE_PROVIDER", "groq")
+    assert index.hedge_backup_provider("openai") == "groq"
+    assert half_open.probe_started is None
+
+
+def test_failing_mock_provider_trips_the_breaker(monkeypatch, breaker_env):
+    monkeypatch.setattr(index, "provider_health", {name: index.ProviderHealth(name) for name in index.PROVIDER_STREAMS})
+
+    async def run():
+        mock = await MockLLMServer(port=0, ttft_ms=1, tokens=3, error_rate=1.0).start()
+        monkeypatch.setenv("GROQ_API_KEY", "test")
+        monkeypatch.setenv("GROQ_BASE_URL", mock.url + "/openai/v1")
+        try:
+            for _ in range(3):
+                events = [event async for event in index.provider_stream("groq", "prompt", {"deadline": index.Deadline()})]
+                assert "429" in events[-1]['error']
+        finally:
+            await index.close_http_client()
+            await mock.close()
+
+    asyncio.run(run())
+    health = index.provider_health["groq"]
+    assert health.state == "open"
+    assert health.snapshot()["errors"] == 3
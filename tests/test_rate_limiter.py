@@ -0,0 +1,82 @@
+import asyncio
+
+import pytest
+
+from api import index
+
+
+def acquire(limiter, key):
+    return asyncio.run(limiter.acquire(key))
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setenv("RATE_LIMIT_RPS", "2")
+    monkeypatch.setenv("RATE_LIMIT_BURST", "3")
+    return index.RateLimiter()
+
+
+def test_burst_is_allowed_then_limited(limiter, clock):
+    assert [acquire(limiter, "1.2.3.4") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert acquire(limiter, "1.2.3.4") == pytest.approx(0.5)
+    assert limiter.stats == {"allowed": 3, "limited": 1}
+
+
+def test_tokens_refill_at_the_configured_rate(limiter, clock):
+    for _ in range(3):
+        acquire(limiter, "1.2.3.4")
+    clock.now += 0.5
+    assert acquire(limiter, "1.2.3.4") == 0.0
+    assert acquire(limiter, "1.2.3.4") == pytest.approx(0.5)
+    # Never refills past the burst
+    clock.now += 60
+    assert [acquire(limiter, "1.2.3.4") for _ in range(4)][-1] == pytest.approx(0.5)
+
+
+def test_clients_have_separate_buckets(limiter, clock):
+    for _ in range(3):
+        acquire(limiter, "1.2.3.4")
+    assert acquire(limiter, "1.2.3.4") > 0
+    assert acquire(limiter, "5.6.7.8") == 0.0
+
+
+def test_least_recently_seen_clients_are_forgotten(monkeypatch, clock):
+    monkeypatch.setenv("RATE_LIMIT_MAX_CLIENTS", "2")
+    limiter = index.RateLimiter()
+    for key in ("a", "b", "c"):
+        acquire(limiter, key)
+    assert limiter.snapshot()["clients"] == 2
+
+
+def test_zero_rate_disables_limiting(monkeypatch, clock):
+    monkeypatch.setenv("RATE_LIMIT_RPS", "0")
+    limiter = index.RateLimiter()
+    assert not limiter.enabled
+    assert all(acquire(limiter, "1.2.3.4") == 0.0 for _ in range(100))
+
+
+def test_cost_is_charged_in_full(limiter, clock):
+    assert asyncio.run(limiter.acquire("1.2.3.4", cost=3)) == 0.0
+    assert asyncio.run(limiter.acquire("1.2.3.4", cost=1)) == pytest.approx(0.5)
+
+
+@pytest.fixture
+def batch_limiter(monkeypatch, limiter):
+    monkeypatch.setattr(index, "rate_limiter", limiter)
+    return limiter
+
+
+def test_batch_larger_than_the_burst_is_rejected(client, batch_limiter):
+    items = [{"text": f"item {i}"} for i in range(4)]
+    response = client.post("/api/predict/batch", json={"items": items}, headers={"x-forwarded-for": "10.0.0.1"})
+    assert response.status_code == 413
+    assert batch_limiter.stats == {"allowed": 0, "limited": 0}
+
+
+def test_batch_spends_one_token_per_item(client, batch_limiter):
+    items = [{"text": f"item {i}"} for i in range(3)]
+    headers = {"x-forwarded-for": "10.0.0.2"}
+    assert client.post("/api/predict/batch", json={"items": items}, headers=headers).status_code == 200
+    response = client.post("/api/predict", json={"text": "one more"}, headers=headers)
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
@@ -0,0 +1,29 @@
+import struct
+
+import pytest
+
+from api import index
+
+
+def float4(value: float) -> float:
+    return struct.unpack("f", struct.pack("f", value))[0]
+
+
+@pytest.mark.parametrize("rank", [0.0, 0.0607927, 0.1, 1 / 3, 0.99999994])
+def test_search_cursor_round_trips_float4_ranks(rank):
+    rank = float4(rank)
+    cursor = index.format_search_cursor(rank, 2 ** 40)
+    assert index.parse_search_cursor(cursor) == (rank, 2 ** 40)
+
+
+@pytest.mark.parametrize("after", ["high,1", "0.5"])
+def test_malformed_search_cursors_are_rejected(client, after):
+    response = client.get(f"/api/history/search?q=prod&after={after}")
+    assert response.status_code == 400
+    assert response.json() == {"error": "Invalid 'after' cursor"}
+
+
+def test_search_pages_cover_every_match_once(client, database, pages):
+    everything = client.get("/api/history/search?q=database&limit=100", headers={"x-forwarded-for": database}).json()["queries"]
+    assert len(everything) == 23
+    assert pages("/api/history/search?q=database&limit=4", database, "after") == [query["id"] for query in everything]
@@ -0,0 +1,90 @@
+import asyncio
+
+from api import index
+from mock_redis import MockRedisServer
+
+
+def sqlite_state(tmp_path, monkeypatch, max_bytes=None):
+    if max_bytes is not None:
+        monkeypatch.setenv("SHARED_STATE_MAX_BYTES", str(max_bytes))
+    return index.SQLiteSharedState(str(tmp_path / "state.db"), "wcgr:")
+
+
+async def query(state, sql):
+    return await state._run(lambda: state._db().execute(sql).fetchall())
+
+
+async def exercise_ttl(state):
+    await state.set("forecast:a", b"hello", 0.2)
+    assert await state.get("forecast:a") == b"hello"
+    assert await state.incr("ratelimit:ip:1", 2, 0.2) == 2
+    assert await state.incr("ratelimit:ip:1", 3, 0.2) == 5
+    await state.delete("forecast:a")
+    assert await state.get("forecast:a") is None
+    await state.set("forecast:b", b"x", 0.2)
+    await asyncio.sleep(0.3)
+    assert await state.get("forecast:b") is None
+    # An expired counter starts over instead of adding to the stale value
+    assert await state.incr("ratelimit:ip:1", 1, 0.2) == 1
+    assert state.stats["errors"] == 0
+
+
+def test_sqlite_entries_expire(tmp_path, monkeypatch):
+    async def run():
+        state = sqlite_state(tmp_path, monkeypatch)
+        try:
+            await exercise_ttl(state)
+        finally:
+            await state.close()
+    asyncio.run(run())
+
+
+def test_redis_entries_expire():
+    async def run():
+        server = await MockRedisServer(port=0, password="secret").start()
+        state = index.RedisSharedState(server.url, "wcgr:")
+        try:
+            await exercise_ttl(state)
+        finally:
+            await state.close()
+            await server.close()
+    asyncio.run(run())
+
+
+def test_sqlite_eviction_keeps_counters_and_breakers(tmp_path, monkeypatch):
+    async def run():
+        state = sqlite_state(tmp_path, monkeypatch, max_bytes=3000)
+        try:
+            await state.incr("ratelimit:1.2.3.4:100", 1, 20)
+            await state.set("breaker:groq", b"1792205345.55", 30)
+            for i in range(20):
+                await state.set(f"forecast:{i}", b"x" * 400, 3600)
+            keys = {key for key, in await query(state, "SELECT key FROM shared_kv")}
+            (total, tracked), = await query(state, "SELECT SUM(length(value)), (SELECT bytes FROM shared_kv_size) FROM shared_kv")
+            return keys, total, tracked
+        finally:
+            await state.close()
+
+    keys, total, tracked = asyncio.run(run())
+    assert "wcgr:ratelimit:1.2.3.4:100" in keys
+    assert "wcgr:breaker:groq" in keys
+    forecasts = sorted(int(key.rsplit(":", 1)[1]) for key in keys if key.startswith("wcgr:forecast:"))
+    # Just enough of the oldest forecasts go, and never the one just written
+    assert forecasts == list(range(20 - len(forecasts), 20))
+    assert len(forecasts) == 7
+    assert total == tracked <= 3000
+
+
+def test_sqlite_eviction_removes_expired_rows_first(tmp_path, monkeypatch):
+    async def run():
+        state = sqlite_state(tmp_path, monkeypatch, max_bytes=3000)
+        try:
+            await state.set("forecast:short", b"x" * 1500, 0.1)
+            await state.set("forecast:old", b"x" * 1000, 3600)
+            await asyncio.sleep(0.2)
+            await state.set("forecast:new", b"x" * 1000, 3600)
+            return {key for key, in await query(state, "SELECT key FROM shared_kv")}
+        finally:
+            await state.close()
+
+    assert asyncio.run(run()) == {"wcgr:forecast:old", "wcgr:forecast:new"}
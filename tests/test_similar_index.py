@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from api import index
+
+
+@pytest.fixture
+def similar(monkeypatch):
+    monkeypatch.delenv("SIMILAR_THRESHOLD", raising=False)
+    return index.SimilarForecastIndex()
+
+
+LEGACY = (
+    "Over the next two quarters we will {}keep the legacy billing system running alongside the new platform, "
+    "with both writing to the shared customer database and a nightly job reconciling the differences"
+)
+
+
+def entry_size(similar, text, output):
+    signature = similar.signature(text)
+    return len(output) + len(text) + signature.itemsize * len(signature) + similar.ENTRY_OVERHEAD
+
+
+def test_rephrased_input_matches_stored_forecast(similar):
+    similar.add("Using production database for testing", "mid", "realistic", "forecast A")
+    match = similar.lookup("using the production database for tests", "mid", "realistic")
+    assert match is not None
+    assert match[0] == "forecast A"
+    assert match[1] >= similar.threshold
+
+
+def test_identical_input_scores_one(similar):
+    similar.add("Rolling out the migration on Friday evening", "mid", "realistic", "forecast A")
+    assert similar.lookup("Rolling out the migration on Friday evening", "mid", "realistic") == ("forecast A", 1.0)
+
+
+def test_unrelated_input_misses(similar):
+    similar.add("Using production database for testing", "mid", "realistic", "forecast A")
+    assert similar.lookup("Letting the intern deploy on Friday", "mid", "realistic") is None
+
+
+@pytest.mark.parametrize("threshold", [None, "0.5"])
+def test_negated_input_is_not_served_from_the_index(monkeypatch, threshold):
+    if threshold is None:
+        monkeypatch.delenv("SIMILAR_THRESHOLD", raising=False)
+    else:
+        monkeypatch.setenv("SIMILAR_THRESHOLD", threshold)
+    similar = index.SimilarForecastIndex()
+    similar.add(LEGACY.format(""), "mid", "realistic", "forecast for keeping it")
+    assert similar.lookup(LEGACY.format("not "), "mid", "realistic") is None
+    assert similar.lookup(LEGACY.format("never "), "mid", "realistic") is None
+    assert similar.lookup(LEGACY.format("").replace("will", "won't"), "mid", "realistic") is None
+    assert similar.lookup(LEGACY.format(""), "mid", "realistic") == ("forecast for keeping it", 1.0)
+
+
+def test_changed_numbers_are_not_served_from_the_index(similar):
+    similar.add("Upgrading the cluster to 3 replicas during peak traffic", "mid", "realistic", "forecast A")
+    assert similar.lookup("Upgrading the cluster to 30 replicas during peak traffic", "mid", "realistic") is None
+    assert similar.lookup("Upgrading the cluster to 3 replicas during peak traffic", "mid", "realistic") is not None
+
+
+def test_stemming_keeps_distinct_words_apart(similar):
+    assert similar.normalize("Postgres") != similar.normalize("PostgreSQL")
+    assert similar.normalize("testing tests tested") == "test test test"
+    assert similar.normalize("databases") == similar.normalize("database")
+
+
+def test_horizon_and_severity_scope_matches(similar):
+    similar.add("Using production database for testing", "mid", "realistic", "forecast A")
+    assert similar.lookup("Using production database for testing", "mid", "worst") is None
+    assert similar.lookup("Using production database for testing", "far", "realistic") is None
+    # Unknown horizons fall back to "mid", as in the prompt
+    assert similar.lookup("Using production database for testing", "someday", "realistic") is not None
+
+
+def test_same_normalized_input_keeps_newer_forecast(similar):
+    similar.add("Using production database for testing", "mid", "realistic", "older")
+    similar.add("USING the production database, for testing!", "mid", "realistic", "newer")
+    assert len(similar) == 1
+    assert similar.lookup("Using production database for testing", "mid", "realistic")[0] == "newer"
+
+
+def test_eviction_drops_least_recently_used(monkeypatch):
+    texts = [
+        "Using production database for testing",
+        "Letting the intern deploy on Friday",
+        "Storing passwords in a spreadsheet",
+    ]
+    probe = index.SimilarForecastIndex()
+    budget = sum(entry_size(probe, text, "forecast") for text in texts[:2])
+    monkeypatch.setenv("SIMILAR_INDEX_MAX_BYTES", str(budget))
+    similar = index.SimilarForecastIndex()
+
+    similar.add(texts[0], "mid", "realistic", "forecast")
+    similar.add(texts[1], "mid", "realistic", "forecast")
+    # A hit refreshes the entry, so the second one is now the oldest
+    assert similar.lookup(texts[0], "mid", "realistic") is not None
+    similar.add(texts[2], "mid", "realistic", "forecast")
+
+    assert len(similar) == 2
+    assert similar.stats["evictions"] == 1
+    assert similar.snapshot()["bytes"] <= budget
+    assert similar.lookup(texts[1], "mid", "realistic") is None
+    assert similar.lookup(texts[0], "mid", "realistic") is not None
+    assert similar.lookup(texts[2], "mid", "realistic") is not None
+
+
+def test_entry_larger_than_budget_is_not_stored(monkeypatch):
+    monkeypatch.setenv("SIMILAR_INDEX_MAX_BYTES", "2048")
+    similar = index.SimilarForecastIndex()
+    similar.add("Using production database for testing", "mid", "realistic", "x" * 4096)
+    assert len(similar) == 0
+
+
+def test_threshold_zero_disables_index(monkeypatch):
+    monkeypatch.setenv("SIMILAR_THRESHOLD", "0")
+    similar = index.SimilarForecastIndex()
+    similar.add("Using production database for testing", "mid", "realistic", "forecast A")
+    assert not similar.enabled
+    assert similar.lookup("Using production database for testing", "mid", "realistic") is None
+
+
+def test_long_inputs_are_signed_off_the_loop_with_the_same_result(similar):
+    text = "production database testing " * 100
+    assert len(text) > similar.inline_chars
+    assert asyncio.run(similar.sign(text)) == similar.signature(text)
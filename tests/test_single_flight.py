@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+
+from api import index
+from mock_llm import MockLLMServer
+
+EXPECTED = "".join(f"token{i} " for i in range(20))
+
+
+@pytest.fixture
+def uncached(monkeypatch):
+    # Only the in-flight broadcast can share work between the requests below
+    monkeypatch.setenv("FORECAST_CACHE_TTL", "0")
+    monkeypatch.setenv("SIMILAR_THRESHOLD", "0")
+    monkeypatch.setattr(index, "forecast_cache", index.ForecastCache())
+    monkeypatch.setattr(index, "similar_index", index.SimilarForecastIndex())
+    monkeypatch.setattr(index, "provider_health", {name: index.ProviderHealth(name) for name in index.PROVIDER_STREAMS})
+    monkeypatch.setattr(index, "inflight_predictions", {})
+
+
+def with_mock(monkeypatch, scenario):
+    async def run():
+        mock = await MockLLMServer(port=0, ttft_ms=50, tokens=20, token_rate=200).start()
+        monkeypatch.setenv("GROQ_API_KEY", "test")
+        monkeypatch.setenv("GROQ_BASE_URL", mock.url + "/openai/v1")
+        try:
+            return await scenario(mock)
+        finally:
+            await index.close_http_client()
+            await mock.close()
+    return asyncio.run(run())
+
+
+async def forecast(text: str = "Deploying on Friday"):
+    events = [event async for event in index.forecast_stream(text, "mid", "realistic", "groq")]
+    return "".join(event.get('output', "") for event in events)
+
+
+def test_identical_requests_share_one_upstream_stream(monkeypatch, uncached):
+    async def scenario(mock):
+        first = asyncio.create_task(forecast())
+        await asyncio.sleep(0.1)
+        # Late joiners replay what was already produced and then follow live
+        outputs = await asyncio.gather(first, *(forecast() for _ in range(4)))
+        return outputs, mock.requests
+
+    outputs, upstream = with_mock(monkeypatch, scenario)
+    assert outputs == [EXPECTED] * 5
+    assert upstream == 1
+    assert index.inflight_predictions == {}
+
+
+def test_different_inputs_are_not_coalesced(monkeypatch, uncached):
+    async def scenario(mock):
+        outputs = await asyncio.gather(forecast("Deploying on Friday"), forecast("Skipping code review"))
+        return outputs, mock.requests
+
+    outputs, upstream = with_mock(monkeypatch, scenario)
+    assert outputs == [EXPECTED] * 2
+    assert upstream == 2
+
+
+def test_one_subscriber_leaving_does_not_stop_the_others(monkeypatch, uncached):
+    async def scenario(mock):
+        leaving = index.forecast_stream("Deploying on Friday", "mid", "realistic", "groq")
+        await anext(leaving)
+        staying = asyncio.create_task(forecast())
+        await asyncio.sleep(0.02)
+        await leaving.aclose()
+        return await staying, mock.requests
+
+    output, upstream = with_mock(monkeypatch, scenario)
+    assert output == EXPECTED
+    assert upstream == 1
+
+
+def test_broadcast_is_cancelled_when_its_last_subscriber_leaves():
+    async def run():
+        stopped = asyncio.Event()
+
+        async def source():
+            try:
+                for i in range(100):
+                    yield {'output': f"token{i} "}
+                    await asyncio.sleep(0.01)
+            finally:
+                stopped.set()
+
+        flight = index.Broadcast("key", source())
+        subscribers = [flight.subscribe(), flight.subscribe()]
+        for subscriber in subscribers:
+            await anext(subscriber)
+        await subscribers[0].aclose()
+        await asyncio.sleep(0.03)
+        assert not stopped.is_set()
+        await subscribers[1].aclose()
+        await asyncio.wait_for(stopped.wait(), 1)
+        return flight.abandoned
+
+    assert asyncio.run(run())
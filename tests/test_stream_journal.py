@@ -0,0 +1,139 @@
+import asyncio
+
+from api import index
+
+
+async def slow_source(started, stopped):
+    started.set()
+    try:
+        for i in range(100):
+            yield {'output': f"token{i} "}
+            await asyncio.sleep(0.01)
+    finally:
+        stopped.set()
+
+
+def test_cancel_stops_a_resumable_generation_before_the_grace_runs_out(monkeypatch):
+    monkeypatch.setenv("STREAM_RESUME_GRACE", "30")
+
+    async def run():
+        journal = index.StreamJournal()
+        started, stopped = asyncio.Event(), asyncio.Event()
+        generation, flight = journal.start(slow_source(started, stopped), resumable=True)
+        frames = flight.subscribe()
+        await anext(frames)
+        await frames.aclose()
+        # Disconnected, but still inside the grace period
+        await asyncio.sleep(0.05)
+        assert not stopped.is_set()
+
+        assert journal.cancel(generation)
+        await asyncio.wait_for(stopped.wait(), 1)
+        assert flight.abandoned
+        assert journal.resume(f"{generation}:1") is None
+        assert not journal.cancel(generation)
+        return journal.snapshot()
+
+    assert asyncio.run(run())["cancelled"] == 1
+
+
+def test_cancel_endpoint_validates_the_generation(client):
+    assert client.post("/api/predict/cancel", json={}).status_code == 400
+    assert client.post("/api/predict/cancel", content=b"not json").status_code == 400
+    response = client.post("/api/predict/cancel", json={"generation": "unknown:3"})
+    assert response.status_code == 200
+    assert response.json() == {"cancelled": False}
+
+
+async def counted_source(calls, tokens=6, delay=0.01):
+    calls.append(1)
+    for i in range(tokens):
+        await asyncio.sleep(delay)
+        yield {'output': f"token{i} "}
+
+
+def parse_frames(frames):
+    parsed = []
+    for frame in frames:
+        event_id, data = frame.strip().split("\n")
+        parsed.append((event_id.removeprefix("id: "), index.json.loads(data.removeprefix("data: "))))
+    return parsed
+
+
+def test_reconnect_with_last_event_id_replays_the_rest_without_a_new_call(monkeypatch):
+    monkeypatch.setenv("STREAM_RESUME_GRACE", "5")
+
+    async def run():
+        journal = index.StreamJournal()
+        calls = []
+        generation, flight = journal.start(counted_source(calls), resumable=True)
+        first = index.journal_frames(generation, flight)
+        received = [await anext(first), await anext(first)]
+        await first.aclose()
+
+        last_event_id = parse_frames(received)[-1][0]
+        resumed = journal.resume(last_event_id)
+        assert resumed is not None
+        received += [frame async for frame in index.journal_frames(*resumed)]
+        return generation, received, calls, journal.snapshot()
+
+    generation, received, calls, stats = asyncio.run(run())
+    frames = parse_frames(received)
+    assert [event_id for event_id, _ in frames] == [f"{generation}:{seq}" for seq in range(1, 7)]
+    assert "".join(event['output'] for _, event in frames) == "".join(f"token{i} " for i in range(6))
+    assert len(calls) == 1
+    assert stats["resumed"] == 1
+
+
+def test_resume_from_a_finished_generation_replays_only_what_was_missed():
+    async def run():
+        journal = index.StreamJournal()
+        generation, flight = journal.start(counted_source([], tokens=3, delay=0))
+        everything = [frame async for frame in index.journal_frames(generation, flight)]
+        replay = [frame async for frame in index.journal_frames(*journal.resume(f"{generation}:1"))]
+        return everything, replay
+
+    everything, replay = asyncio.run(run())
+    assert replay == everything[1:]
+
+
+def test_unknown_or_out_of_range_ids_miss():
+    async def run():
+        journal = index.StreamJournal()
+        generation, flight = journal.start(counted_source([], tokens=2, delay=0))
+        _ = [frame async for frame in index.journal_frames(generation, flight)]
+        misses = [journal.resume(last_event_id) for last_event_id in ("nope:1", f"{generation}:9", f"{generation}:x")]
+        return misses, journal.snapshot()
+
+    misses, stats = asyncio.run(run())
+    assert misses == [None, None, None]
+    assert stats["resume_misses"] == 3
+
+
+def test_abandoned_generation_is_not_resumed():
+    async def run():
+        journal = index.StreamJournal()
+        generation, flight = journal.start(counted_source([], tokens=50))
+        frames = index.journal_frames(generation, flight)
+        await anext(frames)
+        # Not resumable: the generation is cancelled as soon as its only client leaves
+        await frames.aclose()
+        # The inner subscription is closed by the loop's async generator finalizer
+        await asyncio.sleep(0.05)
+        return flight.abandoned, journal.resume(f"{generation}:1")
+
+    assert asyncio.run(run()) == (True, None)
+
+
+def test_finished_generations_expire_after_the_ttl(monkeypatch, clock):
+    monkeypatch.setenv("STREAM_JOURNAL_TTL", "120")
+
+    async def run():
+        journal = index.StreamJournal()
+        generation, flight = journal.start(counted_source([], tokens=1, delay=0))
+        _ = [frame async for frame in index.journal_frames(generation, flight)]
+        assert journal.resume(f"{generation}:0") is not None
+        clock.now += 121
+        return journal.resume(f"{generation}:0")
+
+    assert asyncio.run(run()) is None